@@ -1,36 +1,150 @@
-from flask import Flask, render_template, request, g
+from dataclasses import asdict
+import json
+import time
+
+from flask import (
+    Flask, Response, abort, g, jsonify, render_template, request,
+    stream_with_context, url_for
+)
+from stargaze import metrics
 from stargaze.geocoding import find_coordinates
 from stargaze.cli import parse_length, parse_direction
 from stargaze.core import stargaze
+from stargaze.jobs import QueueFull, get_queue
 from stargaze.sessions import SessionFactory
+from stargaze.settings import settings
 
 app = Flask(__name__)
 
 
-@app.route('/', methods=('GET', 'POST'))
+@app.route('/')
 def index():
-    if request.method == 'POST':
-        try:
-            call_function = True
-            input_whereabouts = request.form.get('whereabouts')
-
-            if input_whereabouts:
-                coordinates = find_coordinates(input_whereabouts)
-                input_radius = request.form.get('radius')
-                input_direction = request.form.get('direction', '0.0')
-                direction = parse_direction(input_direction)
-                if input_radius:
-                    radius = parse_length(input_radius)
-                    spots = stargaze(coordinates, radius, direction)
-                    return render_template('index.html', whereabouts=input_whereabouts, radius=input_radius,
-                                           spots=spots, direction=direction, call_function=call_function)
-                radius = 3000
-                spots = stargaze(coordinates, radius, direction)
-                return render_template('index.html', whereabouts=input_whereabouts, radius=radius,
-                                       spots=spots, direction=direction, call_function=call_function)
-        except IndexError:
-            return render_template('index.html', coordinates=None)
-    return render_template('index.html', coordinates=None)
+    return render_template('index.html')
+
+
+def _search_job(whereabouts: str,
+                radius: float,
+                direction: float | None,
+                progress) -> dict:
+    progress('geocoding')
+    try:
+        origin = find_coordinates(whereabouts)
+    except IndexError:
+        raise ValueError(f'{whereabouts} could not be found') from None
+    spots = stargaze(origin, radius, direction, progress)
+    return {'origin': origin, 'radius': radius, 'spots': spots}
+
+
+@app.post('/api/searches')
+def submit_search():
+    """Submits a search and returns its id without waiting for it."""
+    form = request.get_json(silent=True) or request.form
+    whereabouts = form.get('whereabouts')
+    if not isinstance(whereabouts, str) or not whereabouts.strip():
+        return jsonify(error='whereabouts must be a non-empty string'), 400
+    # JSON clients may give numbers, meters and degrees respectively
+    radius = form.get('radius')
+    direction = form.get('direction')
+    try:
+        radius = parse_length(
+            str(radius) if radius not in (None, '') else '3km'
+        )
+    except Exception:
+        return jsonify(
+            error=f'radius must be a length, e.g. "3km" or 3000, not {radius!r}'
+        ), 400
+    try:
+        direction = (
+            parse_direction(str(direction))
+            if direction not in (None, '') else None
+        )
+    except Exception:
+        return jsonify(
+            error='direction must be a cardinal point or an azimuth, e.g. '
+            f'"south" or 180, not {direction!r}'
+        ), 400
+    try:
+        job = get_queue().submit(_search_job, whereabouts, radius, direction)
+    except QueueFull:
+        response = jsonify(error='too many searches are running, retry later')
+        response.headers['Retry-After'] = '30'
+        return response, 503
+    location = url_for('search_status', id=job.id)
+    return jsonify(job.snapshot()), 202, {'Location': location}
+
+
+def _job(id: str):
+    job = get_queue().get(id)
+    if job is None:
+        abort(404)
+    return job
+
+
+@app.get('/api/searches/<id>')
+def search_status(id):
+    return jsonify(_job(id).snapshot())
+
+
+@app.get('/api/searches/<id>/result')
+def search_result(id):
+    """Returns the spots of a finished search as GeoJSON."""
+    job = _job(id)
+    snapshot = job.snapshot()
+    if snapshot['state'] == 'failed':
+        return jsonify(snapshot), 422
+    if snapshot['state'] != 'done':
+        return jsonify(snapshot), 202
+    features = [
+        {
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [spot.lon, spot.lat]},
+            'properties': {'rank': rank}
+        }
+        for rank, spot in enumerate(snapshot['result']['spots'], start=1)
+    ]
+    return Response(
+        json.dumps({'type': 'FeatureCollection', 'features': features}),
+        mimetype='application/geo+json'
+    )
+
+
+@app.get('/api/searches/<id>/events')
+def search_events(id):
+    """Streams the state of a search as server-sent events.
+
+    Every change is sent as a 'progress' event, the last one as a 'done' or
+    'failed' event, each carrying the state of the job as JSON. A stream holds
+    a server thread, so it is closed after a while and the client reconnects,
+    resuming from the version in the `Last-Event-ID` header."""
+    job = _job(id)
+    config = settings['jobs']
+    last_event = request.headers.get('Last-Event-ID', '')
+    version = int(last_event) if last_event.isdigit() else -1
+    if job.over:
+        # the final event is sent again to a client reconnecting after it
+        version = min(version, job.version - 1)
+
+    def events():
+        nonlocal version
+        yield f'retry: {config["retry"] * 1000:.0f}\n\n'
+        deadline = time.monotonic() + config['stream']
+        while (remaining := deadline - time.monotonic()) > 0:
+            if not job.wait(version, min(config['heartbeat'], remaining)):
+                yield ': keep-alive\n\n'
+                continue
+            snapshot = job.snapshot()
+            version = snapshot['version']
+            event = snapshot['state'] if job.over else 'progress'
+            data = json.dumps(snapshot, default=asdict)
+            yield f'event: {event}\nid: {version}\ndata: {data}\n\n'
+            if job.over:
+                return
+
+    return Response(
+        stream_with_context(events()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
 
 @app.route('/about')
@@ -38,9 +152,26 @@ def about():
     return render_template('about.html')
 
 
+@app.route('/status')
+def status():
+    return jsonify(
+        pools=SessionFactory.get_instance().stats(),
+        jobs=get_queue().stats(),
+        plans=list(metrics.registry.plans)
+    )
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(
+        metrics.registry.render(), mimetype='text/plain; version=0.0.4'
+    )
+
+
 def get_db():
+    """Returns the session of the request, checked out on first use."""
     if 'db' not in g:
-        g.db = SessionFactory.get_session()
+        g.db = SessionFactory.get_instance().get_session()
     return g.db
 
 
@@ -48,4 +179,6 @@ def get_db():
 def teardown_db(exception):
     db = g.pop('db', None)
     if db is not None:
-        SessionFactory.get_instance().close()
+        if exception is None:
+            db.commit()
+        SessionFactory.get_instance().put_session(db)
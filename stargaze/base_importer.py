@@ -1,10 +1,17 @@
 from abc import ABC, abstractmethod
 
+from stargaze import metrics
 from stargaze.commons import BoundingBox
 
 
 class BaseImporter(ABC):
 
+    # name of the remote data source, used to limit concurrent requests to it
+    source: str | None = None
+
+    # whether the extract is received while being transformed and loaded
+    stream: bool = False
+
     @abstractmethod
     def fetch(self, bounds: BoundingBox):
         """Fetches raw data extract."""
@@ -17,6 +24,23 @@ class BaseImporter(ABC):
     def load(self, data):
         """Loads transformed data into the database."""
 
+    def batches(self, extract):
+        """Splits raw data extract into parts transformed one at a time."""
+        yield extract
+
     def run(self, bounds: BoundingBox, session) -> None:
-        """Executes the pipeline."""
-        self.load(self.transform(self.fetch(bounds)), session)
+        """Executes the pipeline, timing each of its phases."""
+        name = type(self).__qualname__
+        with metrics.span('import', importer=name, phase='fetch'):
+            extract = self.fetch(bounds)
+        batches = iter(self.batches(extract))
+        while True:
+            # a streamed extract is received while the batches are taken
+            with metrics.span('import', importer=name, phase='receive'):
+                batch = next(batches, None)
+            if batch is None:
+                break
+            with metrics.span('import', importer=name, phase='transform'):
+                data = self.transform(batch)
+            with metrics.span('import', importer=name, phase='load'):
+                self.load(data, session)
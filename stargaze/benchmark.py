@@ -0,0 +1,568 @@
+"""Stage-level benchmarks.
+
+Every stage of a search is timed on synthetic data, so that regressions can be
+caught and hardware sized without the remote services. Overpass responses and
+GeoTIFF rasters are generated for the requested bounds at a given density of
+features per tile, and served by a local HTTP stand-in for the Overpass API and
+OpenTopography, which the importers are pointed at. For every stage the elapsed
+time, the throughput and the peak memory allocated by Python are reported.
+
+Encoding geometries for loading, as WKT and as batched EWKB, is measured on
+random paths as well. Without `--database` only fetching, transforming and
+encoding is measured. With it, the
+importers also load into the database configured in `credentials.toml`, in
+transactions which are rolled back, and the missing tile check, a cold import
+and the search are measured at several radii. The cold import persists its
+data, so point the credentials at a disposable database."""
+
+
+from argparse import ArgumentParser
+from array import array
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import math
+import os
+import random
+import re
+import shutil
+import struct
+import threading
+import time
+import tracemalloc
+from urllib.parse import parse_qs, urlsplit
+
+from stargaze import coverage
+from stargaze import wkt
+from stargaze.commons import BoundingBox, Coordinates, Path
+
+
+_bbox = re.compile(r'\[bbox:([-\d.]+),([-\d.]+),([-\d.]+),([-\d.]+)\]')
+_statement = re.compile(r'(way|rel)\[(\w+)=(\w+)\]')
+
+_roads = ('primary', 'secondary', 'tertiary', 'residential', 'track')
+_land = ('forest', 'farmyard', 'construction')
+
+
+def _path(rng: random.Random, bounds: BoundingBox, vertices: int, closed: bool):
+    """Returns a random path within the bounds."""
+    lat = rng.uniform(bounds.minlat, bounds.maxlat)
+    lon = rng.uniform(bounds.minlon, bounds.maxlon)
+    step = (bounds.maxlat - bounds.minlat) / 200
+    if closed:
+        radius = step * rng.uniform(1, 5)
+        path = [
+            {
+                'lat': lat + radius * math.sin(2 * math.pi * i / vertices),
+                'lon': lon + radius * math.cos(2 * math.pi * i / vertices)
+            }
+            for i in range(vertices)
+        ]
+        return path + [path[0]]
+    path = []
+    for _ in range(vertices):
+        path.append({'lat': lat, 'lon': lon})
+        lat += rng.uniform(-step, step)
+        lon += rng.uniform(-step, step)
+    return path
+
+
+def _bounds(path) -> dict:
+    return {
+        'minlat': min(vertex['lat'] for vertex in path),
+        'minlon': min(vertex['lon'] for vertex in path),
+        'maxlat': max(vertex['lat'] for vertex in path),
+        'maxlon': max(vertex['lon'] for vertex in path)
+    }
+
+
+def overpass_fixture(bounds: BoundingBox, density: int, seed: int = 0) -> dict:
+    """Returns a synthetic Overpass response for the bounds.
+
+    The response has `density` features per tile, mostly roads, then land,
+    residential areas and multipolygons, and is the same for the same bounds
+    and seed."""
+    rng = random.Random(f'{seed}:{bounds}')
+    count = max(1, round(density * len(coverage.tiles(bounds))))
+    elements = []
+    next_node = 1
+    for id in range(1, count + 1):
+        kind = rng.random()
+        if kind < 0.95:
+            closed = kind >= 0.6
+            path = _path(rng, bounds, rng.randint(4, 20), closed)
+            nodes = list(range(next_node, next_node + len(path)))
+            next_node += len(path)
+            if closed:
+                nodes[-1] = nodes[0]
+                tags = (
+                    {'landuse': rng.choice(_land)} if kind < 0.85
+                    else {'landuse': 'residential'}
+                )
+            else:
+                tags = {
+                    'highway': rng.choice(_roads),
+                    'lit': rng.choice(('yes', 'no'))
+                }
+            elements.append({
+                'type': 'way', 'id': id, 'bounds': _bounds(path),
+                'nodes': nodes, 'geometry': path, 'tags': tags
+            })
+        else:
+            members = [
+                {
+                    'type': 'way', 'ref': count + 2 * id + i, 'role': role,
+                    'geometry': _path(rng, bounds, rng.randint(8, 30), True)
+                }
+                for i, role in enumerate(('outer', 'inner'))
+            ]
+            elements.append({
+                'type': 'relation', 'id': id,
+                'bounds': _bounds(members[0]['geometry']),
+                'members': members,
+                'tags': {'type': 'multipolygon', 'landuse': 'forest'}
+            })
+    return {
+        'version': 0.6,
+        'generator': 'stargaze benchmark',
+        'osm3s': {
+            'timestamp_osm_base': datetime.now(timezone.utc)
+            .strftime('%Y-%m-%dT%H:%M:%SZ')
+        },
+        'elements': elements
+    }
+
+
+def geotiff_fixture(bounds: BoundingBox, resolution: float = 1 / 3600) -> bytes:
+    """Returns a synthetic elevation raster of the bounds as GeoTIFF.
+
+    The raster is an uncompressed single strip of 16-bit samples in WGS84 with
+    the given resolution in degrees, one arc-second like SRTMGL1 by default,
+    holding a few smooth hills."""
+    width = max(1, round((bounds.maxlon - bounds.minlon) / resolution))
+    height = max(1, round((bounds.maxlat - bounds.minlat) / resolution))
+    samples = bytearray()
+    for row in range(height):
+        y = math.sin(row / height * 4 * math.pi)
+        samples += struct.pack(
+            f'<{width}h',
+            *(
+                round(500 + 200 * y * math.cos(col / width * 4 * math.pi))
+                for col in range(width)
+            )
+        )
+    geokeys = [
+        1, 1, 0, 3,
+        1024, 0, 1, 2,  # geographic model
+        1025, 0, 1, 1,  # pixel is area
+        2048, 0, 1, 4326  # WGS84
+    ]
+    entries = [
+        (256, 4, [width]),
+        (257, 4, [height]),
+        (258, 3, [16]),
+        (259, 3, [1]),
+        (262, 3, [1]),
+        (273, 4, [0]),
+        (277, 3, [1]),
+        (278, 4, [height]),
+        (279, 4, [len(samples)]),
+        (284, 3, [1]),
+        (339, 3, [2]),
+        (33550, 12, [resolution, resolution, 0.0]),
+        (
+            33922, 12, [0.0, 0.0, 0.0, bounds.minlon, bounds.maxlat, 0.0]
+        ),
+        (34735, 3, geokeys),
+    ]
+    formats = {3: 'H', 4: 'I', 12: 'd'}
+    ifd_size = 2 + 12 * len(entries) + 4
+    data_offset = 8 + ifd_size
+    extra = bytearray()
+    # values which do not fit into an entry follow the directory
+    payloads = []
+    for tag, type, values in entries:
+        payload = struct.pack(f'<{len(values)}{formats[type]}', *values)
+        if len(payload) > 4:
+            payloads.append(data_offset + len(extra))
+            extra += payload
+        else:
+            payloads.append(payload.ljust(4, b'\0'))
+    strip_offset = data_offset + len(extra)
+    ifd = bytearray(struct.pack('<H', len(entries)))
+    for (tag, type, values), payload in zip(entries, payloads):
+        if tag == 273:
+            payload = struct.pack('<I', strip_offset)
+        elif isinstance(payload, int):
+            payload = struct.pack('<I', payload)
+        ifd += struct.pack('<HHI', tag, type, len(values)) + payload
+    ifd += struct.pack('<I', 0)
+    header = b'II' + struct.pack('<HI', 42, 8)
+    return header + bytes(ifd) + bytes(extra) + bytes(samples)
+
+
+class StandIn:
+    """Local HTTP stand-in for the Overpass API and OpenTopography.
+
+    Responses are generated for the requested bounds at the given density and
+    replayed from memory when requested again, so that a warm-up request keeps
+    generating them out of measurements. The number of requests and bytes
+    served is counted."""
+
+    def __init__(self, density: int, seed: int = 0):
+        self.density = density
+        self.seed = seed
+        self.requests = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self._responses = {}
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length).decode()
+                key = (url.path, url.query, body, stand_in.density)
+                if key in stand_in._responses:
+                    content_type, payload = stand_in._responses[key]
+                elif url.path == '/api/interpreter':
+                    content_type, payload = stand_in._overpass(body)
+                elif url.path == '/API/globaldem':
+                    content_type, payload = stand_in._globaldem(
+                        parse_qs(url.query)
+                    )
+                else:
+                    self.send_error(404)
+                    return
+                stand_in._responses[key] = content_type, payload
+                with stand_in._lock:
+                    stand_in.requests += 1
+                    stand_in.bytes += len(payload)
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_POST = do_GET
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True
+        )
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return f'http://{host}:{port}'
+
+    def _overpass(self, query: str) -> tuple[str, bytes]:
+        south, west, north, east = map(float, _bbox.search(query).groups())
+        bounds = BoundingBox(
+            minlat=south, minlon=west, maxlat=north, maxlon=east
+        )
+        response = overpass_fixture(bounds, self.density, self.seed)
+        selected = {
+            ('way' if type == 'way' else 'relation', key, value)
+            for type, key, value in _statement.findall(query)
+        }
+        response['elements'] = [
+            element for element in response['elements']
+            if any(
+                (element['type'], key, value) in selected
+                for key, value in element['tags'].items()
+            )
+        ]
+        if 'out ids' in query:
+            response['elements'] = [
+                {'type': element['type'], 'id': element['id']}
+                for element in response['elements']
+            ]
+        return 'application/json', json.dumps(response).encode()
+
+    def _globaldem(self, params: dict) -> tuple[str, bytes]:
+        bounds = BoundingBox(
+            minlat=float(params['south'][0]), minlon=float(params['west'][0]),
+            maxlat=float(params['north'][0]), maxlon=float(params['east'][0])
+        )
+        return 'image/tiff', geotiff_fixture(bounds)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class Report:
+    """Collects measurements of stages and prints them as a table."""
+
+    def __init__(self):
+        self.rows = []
+
+    @contextmanager
+    def measure(self, stage: str, case: str, items: str = 'items'):
+        """Measures the enclosed block.
+
+        The block may set `count` and `bytes` of the yielded dictionary to
+        report throughput."""
+        result = {'count': None, 'bytes': None}
+        tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            yield result
+        finally:
+            seconds = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        self.rows.append((stage, case, seconds, result, items, peak))
+        self._print(self.rows[-1])
+
+    @staticmethod
+    def _print(row) -> None:
+        stage, case, seconds, result, items, peak = row
+        throughput = []
+        if result['count'] is not None:
+            throughput.append(f'{result["count"] / seconds:10.0f} {items}/s')
+        if result['bytes'] is not None:
+            megabytes = result['bytes'] / 2 ** 20
+            throughput.append(f'{megabytes / seconds:8.2f} MB/s')
+        print(
+            f'{stage:34} {case:24} {seconds:9.3f} s '
+            f'{peak / 2 ** 20:9.1f} MB peak  {"  ".join(throughput)}',
+            flush=True
+        )
+
+
+def _elements(data) -> int:
+    if isinstance(data, list) and data and isinstance(data[0], list):
+        return sum(map(len, data))
+    return len(data) if isinstance(data, list) else 1
+
+
+def benchmark_encoding(report: Report,
+                       geometries: int,
+                       vertices: int,
+                       seed: int = 0) -> None:
+    """Measures WKT and batched EWKB encoding of random geometries, given both
+    as lists of coordinates and as compact paths."""
+    rng = random.Random(seed)
+    paths = [
+        [
+            Coordinates(lat=rng.uniform(-90, 90), lon=rng.uniform(-180, 180))
+            for _ in range(vertices)
+        ]
+        for _ in range(geometries)
+    ]
+    buffer = array('d')
+    compact = [
+        Path.extend(buffer, ({'lon': p.lon, 'lat': p.lat} for p in path))
+        for path in paths
+    ]
+    cases = {
+        ('str(Polygon)', 'coordinates'):
+            lambda: [str(wkt.Polygon(p)) for p in paths],
+        ('str(LineString)', 'coordinates'):
+            lambda: [str(wkt.LineString(p)) for p in paths],
+        ('str(Polygon)', 'path'):
+            lambda: [str(wkt.Polygon(p)) for p in compact],
+        ('encode(Polygon)', 'coordinates'):
+            lambda: wkt.encode([wkt.Polygon(p) for p in paths]),
+        ('encode(Polygon)', 'path'):
+            lambda: wkt.encode([wkt.Polygon(p) for p in compact]),
+        ('encode(LineString)', 'path'):
+            lambda: wkt.encode([wkt.LineString(p) for p in compact]),
+    }
+    for (stage, case), encode in cases.items():
+        with report.measure(stage, case, 'vertices') as result:
+            encode()
+            result['count'] = geometries * vertices
+
+
+def benchmark_importers(report: Report,
+                        stand_in: StandIn,
+                        bounds: BoundingBox,
+                        session_factory=None) -> None:
+    """Measures fetch, transform and load of every importer on the bounds."""
+    os.environ.setdefault('OpenTopo_API_Key', 'benchmark')
+    from stargaze.combined_importer import CombinedImporter
+    from stargaze.land_importer import LandImporter
+    from stargaze.relief_importer import ReliefImporter
+    from stargaze.residential_area_importer import ResidentialAreaImporter
+    from stargaze.road_importer import RoadImporter
+
+    overpass = f'{stand_in.url}/api/interpreter'
+    importers = [
+        LandImporter(endpoint=overpass),
+        ResidentialAreaImporter(endpoint=overpass),
+        RoadImporter(endpoint=overpass),
+        CombinedImporter(
+            [
+                LandImporter(endpoint=overpass),
+                ResidentialAreaImporter(endpoint=overpass),
+                RoadImporter(endpoint=overpass)
+            ],
+            endpoint=overpass
+        ),
+        ReliefImporter(endpoint=f'{stand_in.url}/API/globaldem'),
+    ]
+    case = f'density {stand_in.density}'
+    for importer in importers:
+        name = type(importer).__qualname__
+        relief = isinstance(importer, ReliefImporter)
+        warm_up = importer.fetch(bounds)
+        if relief:
+            for path in warm_up:
+                path.unlink()
+        served = stand_in.bytes
+        with report.measure(f'{name}.fetch', case, 'elements') as result:
+            extract = importer.fetch(bounds)
+            if not relief:
+                result['count'] = len(extract.elements)
+            result['bytes'] = stand_in.bytes - served
+        if relief and shutil.which('raster2pgsql') is None:
+            print(f'{name}.transform skipped, raster2pgsql not found')
+            for path in extract:
+                path.unlink()
+            continue
+        with report.measure(f'{name}.transform', case, 'rows') as result:
+            data = importer.transform(extract)
+            if not relief:
+                result['count'] = _elements(data)
+        if session_factory is None:
+            if relief:
+                data.unlink()
+            continue
+        session = session_factory.get_session()
+        try:
+            with report.measure(f'{name}.load', case, 'rows') as result:
+                importer.load(data, session)
+                if not relief:
+                    result['count'] = _elements(data)
+        finally:
+            session.rollback()
+            session_factory.put_session(session)
+
+
+def benchmark_search(report: Report,
+                     stand_in: StandIn,
+                     origin: Coordinates,
+                     radii: list[float]) -> None:
+    """Measures the missing tile check, a cold import and the search."""
+    from stargaze.settings import settings
+
+    # the importers of the core are configured on its import
+    settings['overpass']['endpoint'] = f'{stand_in.url}/api/interpreter'
+    settings['relief']['endpoint'] = f'{stand_in.url}/API/globaldem'
+    # synthetic rasters must not end up in the DEM store, where real imports
+    # of the same tiles would pick them up
+    settings['relief']['store']['enabled'] = False
+    settings['relief']['store']['offline'] = False
+    from stargaze import core
+    from stargaze import wkt
+    from stargaze.sessions import SessionFactory
+
+    case = f'density {stand_in.density}'
+    factory = SessionFactory.get_instance()
+    for radius in radii:
+        radius_case = f'{case}, {radius / 1000:g} km'
+        with report.measure(
+            'identify_missing_tiles', radius_case, 'tiles'
+        ) as result:
+            missing = core.identify_missing_tiles(origin, radius)
+            result['count'] = len(missing)
+        with report.measure('import_tiles', radius_case, 'tiles') as result:
+            core.import_tiles(missing)
+            result['count'] = len(missing)
+        with report.measure('stargaze_search', radius_case, 'spots') as result:
+            with factory.session_scope(readonly=True) as session:
+                with session.cursor() as cursor:
+                    cursor.execute(
+                        'select lon, lat from stargaze_search('
+                        'ST_GeomFromText(%s, 4326)::geography, '
+                        '%s, %s, %s, %s, %s)',
+                        (
+                            str(wkt.Point(origin)), radius, 180.0,
+                            settings['hillshade']['altitude'], None,
+                            settings['search']['spots']
+                        )
+                    )
+                    result['count'] = len(cursor.fetchall())
+
+
+def main():
+    parser = ArgumentParser(
+        description=\
+            'measures stages of importing and searching on synthetic data.'
+    )
+    parser.add_argument(
+        '--bounds', default='49.98,19.88,50.02,19.92',
+        metavar='south,west,north,east',
+        help='bounds the importers are run on'
+    )
+    parser.add_argument(
+        '--densities', default='100,1000', metavar='features',
+        help='comma separated numbers of features per tile'
+    )
+    parser.add_argument(
+        '--radii', default='1000,3000,10000', metavar='meters',
+        help='comma separated search radii, requires --database'
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--geometries', type=int, default=10000,
+        help='number of random geometries encoded'
+    )
+    parser.add_argument(
+        '--vertices', type=int, default=50,
+        help='number of vertices of every encoded geometry'
+    )
+    parser.add_argument(
+        '--database', action='store_true',
+        help='also measure loading and searching, see the module documentation'
+    )
+    args = parser.parse_args()
+    south, west, north, east = map(float, args.bounds.split(','))
+    bounds = BoundingBox(minlat=south, minlon=west, maxlat=north, maxlon=east)
+    origin = Coordinates(lat=(south + north) / 2, lon=(west + east) / 2)
+    session_factory = None
+    if args.database:
+        from stargaze.sessions import SessionFactory
+        session_factory = SessionFactory.get_instance()
+    report = Report()
+    benchmark_encoding(report, args.geometries, args.vertices, args.seed)
+    try:
+        with StandIn(0, args.seed) as stand_in:
+            densities = map(int, args.densities.split(','))
+            for index, density in enumerate(densities):
+                stand_in.density = density
+                benchmark_importers(report, stand_in, bounds, session_factory)
+                if args.database:
+                    # every density is searched in an area not imported yet
+                    benchmark_search(
+                        report,
+                        stand_in,
+                        Coordinates(lat=origin.lat, lon=origin.lon + index),
+                        [float(radius) for radius in args.radii.split(',')]
+                    )
+    finally:
+        if session_factory is not None:
+            session_factory.close()
+
+
+__all__ = [
+    'Report', 'StandIn', 'benchmark_encoding', 'benchmark_importers',
+    'benchmark_search', 'geotiff_fixture', 'overpass_fixture'
+]
+
+
+if __name__ == '__main__':
+    main()
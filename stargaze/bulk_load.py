@@ -0,0 +1,161 @@
+"""Bulk loading of rows into the database.
+
+Rows are streamed with `COPY ... FROM STDIN` into a temporary staging table and
+then merged into the target table with a single set-based upsert, which is much
+cheaper for the database than parsing and planning a multi-row `insert` for
+every page of rows."""
+
+
+import io
+from itertools import islice
+
+from psycopg2 import sql
+
+from stargaze import metrics
+from stargaze import wkt
+from stargaze.commons import BoundingBox
+
+
+class _RowReader(io.TextIOBase):
+    """File-like object producing rows in the text format of `COPY`.
+
+    Geometries in the columns listed in `geometries` are encoded as EWKB in
+    pages of `page_size` rows with `wkt.encode`."""
+
+    def __init__(self,
+                 rows,
+                 columns: tuple[str, ...],
+                 geometries: tuple[str, ...] = (),
+                 page_size: int = 1000):
+        self._columns = columns
+        self._geometries = geometries
+        self._lines = self._generate(iter(rows), page_size)
+        self._buffer = ''
+        self.count = 0
+
+    def readable(self):
+        return True
+
+    def _generate(self, rows, page_size: int):
+        while page := list(islice(rows, page_size)):
+            encoded = {
+                column: wkt.encode([row[column] for row in page])
+                for column in self._geometries
+            }
+            for index, row in enumerate(page):
+                yield '\t'.join(
+                    encoded[column][index] if column in encoded
+                    else _field(row[column])
+                    for column in self._columns
+                ) + '\n'
+
+    def read(self, size: int = -1) -> str:
+        parts = [self._buffer]
+        length = len(self._buffer)
+        while size < 0 or length < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            parts.append(line)
+            length += len(line)
+            self.count += 1
+        data = ''.join(parts)
+        if size < 0:
+            size = len(data)
+        self._buffer = data[size:]
+        return data[:size]
+
+
+_escapes = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def _field(value) -> str:
+    if value is None:
+        return '\\N'
+    return str(value).translate(_escapes)
+
+
+def upsert(session,
+           table: str,
+           columns: tuple[str, ...],
+           rows,
+           key: str = 'ref',
+           geometries: tuple[str, ...] = ()) -> int:
+    """Loads rows into the table, updating the rows with the same key.
+
+    Every row is a mapping from column names to values, which are passed to the
+    database in their textual representation, except for the columns listed in
+    `geometries`, whose values are `wkt` geometries sent as EWKB. The rows are
+    consumed lazily, so they can be produced while being loaded. When the same
+    key occurs more than once, an arbitrary one of the rows is kept. Returns
+    the number of rows read."""
+
+    staging = sql.Identifier(f'{table}_staging')
+    column_list = sql.SQL(', ').join(map(sql.Identifier, columns))
+    reader = _RowReader(rows, columns, geometries)
+    with session.cursor() as cursor:
+        cursor.execute(
+            sql.SQL(
+                'create temp table if not exists {staging} on commit drop as '
+                'select {columns} from {table} with no data'
+            ).format(
+                staging=staging, columns=column_list, table=sql.Identifier(table)
+            )
+        )
+        cursor.copy_expert(
+            sql.SQL('copy {staging} ({columns}) from stdin')
+            .format(staging=staging, columns=column_list),
+            reader
+        )
+        cursor.execute(
+            sql.SQL(
+                'insert into {table} ({columns}) '
+                'select distinct on ({key}) {columns} from {staging} '
+                'on conflict ({key}) do update set {updates}'
+            ).format(
+                table=sql.Identifier(table),
+                columns=column_list,
+                key=sql.Identifier(key),
+                staging=staging,
+                updates=sql.SQL(', ').join(
+                    sql.SQL('{column} = excluded.{column}')
+                    .format(column=sql.Identifier(column))
+                    for column in columns if column != key
+                )
+            )
+        )
+        cursor.execute(sql.SQL('truncate {staging}').format(staging=staging))
+    metrics.increment('rows_loaded', reader.count, table=table)
+    return reader.count
+
+
+def prune(session,
+          table: str,
+          bounds: BoundingBox,
+          refs,
+          key: str = 'ref') -> int:
+    """Deletes rows within the bounds whose key is not among `refs`.
+
+    Rows are selected by their `shape` intersecting the bounds, the same way
+    the Overpass API selects features by a bounding box, i.e. in planar terms:
+    as a geography, the edges of the box would be great-circle arcs bulging
+    past the queried box into the neighbouring tiles. Returns the number of
+    deleted rows."""
+
+    with session.cursor() as cursor:
+        cursor.execute(
+            sql.SQL(
+                'delete from {table} '
+                'where ST_Intersects('
+                'shape::geometry, ST_MakeEnvelope(%s, %s, %s, %s, 4326)) '
+                'and {key} <> all(%s::bigint[])'
+            ).format(table=sql.Identifier(table), key=sql.Identifier(key)),
+            (
+                bounds.minlon, bounds.minlat, bounds.maxlon, bounds.maxlat,
+                sorted(refs)
+            )
+        )
+        return cursor.rowcount
+
+
+__all__ = ['prune', 'upsert']
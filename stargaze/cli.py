@@ -2,10 +2,17 @@
 
 
 from argparse import ArgumentParser
+import sys
+import time
 
 import pint
 
-from stargaze.core import stargaze
+from stargaze import metrics
+from stargaze import wkt
+from stargaze.commons import Coordinates
+from stargaze.core import (
+    import_extract, refresh, seed, stargaze, stargaze_many
+)
 from stargaze.geocoding import find_coordinates
 from stargaze.sessions import SessionFactory
 
@@ -26,27 +33,72 @@ def parse_length(length: str) -> float:
     quantity = ureg(length)
     if not isinstance(quantity, pint.Quantity):
         return quantity
+    if quantity.dimensionless:
+        # bare numbers are meters
+        return float(quantity.magnitude)
     if not quantity.check(ureg.meter):
         raise ValueError(f"The input '{length}' does not represent a length.")
     return quantity.to(ureg.meter).magnitude
 
 
+def parse_duration(duration: str) -> float:
+    """Parses textual representation of a duration and returns it in seconds."""
+    quantity = ureg(duration)
+    if not isinstance(quantity, pint.Quantity):
+        return quantity
+    if not quantity.check(ureg.second):
+        raise ValueError(f"The input '{duration}' does not represent a duration.")
+    return quantity.to(ureg.second).magnitude
+
+
 def parse_direction(direction: str) -> float:
     """Parses textual direction and returns numeric azimuth."""
-    return _directions.get(direction.casefold()) or float(direction)
+    azimuth = _directions.get(direction.casefold())
+    return float(direction) if azimuth is None else azimuth
+
+
+def parse_bbox(bbox: str) -> str:
+    """Parses a south,west,north,east bounding box and returns it as WKT."""
+    south, west, north, east = map(float, bbox.split(','))
+    if north <= south or east <= west:
+        raise ValueError(f"The input '{bbox}' is not a bounding box.")
+    return str(wkt.Polygon([
+        Coordinates(lat=south, lon=west),
+        Coordinates(lat=south, lon=east),
+        Coordinates(lat=north, lon=east),
+        Coordinates(lat=north, lon=west),
+        Coordinates(lat=south, lon=west)
+    ]))
 
 
-def main():
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['seed']:
+        seed_main(argv[1:])
+        return
+    if argv[:1] == ['import']:
+        import_main(argv[1:])
+        return
+    if argv[:1] == ['refresh']:
+        refresh_main(argv[1:])
+        return
     parser = ArgumentParser(
         prog='stargaze',
         description=\
             'stargaze helps you find the best spot for astronomical '\
             'observations.'
     )
-    parser.add_argument(
-        '--near', required=True, metavar='whereabouts',
+    origins = parser.add_mutually_exclusive_group(required=True)
+    origins.add_argument(
+        '--near', metavar='whereabouts',
         help='description of whereabouts, either coordinates or locality name'
     )
+    origins.add_argument(
+        '--origins', metavar='file',
+        help=\
+            'file with descriptions of whereabouts, one per line, to search '\
+            'around each of them'
+    )
     parser.add_argument(
         '--within', default='1km', metavar='radius',
         help='search radius, e.g. "10km"'
@@ -57,14 +109,147 @@ def main():
             'observation direction, either cardinal point or azimuth, e.g. '\
             '"south", "SE", "120.3"'
     )
-    args = parser.parse_args()
-    whereabouts = find_coordinates(args.near)
+    parser.add_argument(
+        '--profile', action='store_true',
+        help=\
+            'search without the cache, then print where the time went and '\
+            'the plans of the search queries'
+    )
+    args = parser.parse_args(argv)
     radius = parse_length(args.within)
     direction = args.head and parse_direction(args.head)
-    spots = stargaze(whereabouts, radius, direction)
-    SessionFactory.get_instance().close()
-    for spot in spots:
-        print(spot)
+    if args.origins:
+        search_many(args.origins, radius, direction, args.profile)
+    else:
+        whereabouts = find_coordinates(args.near)
+        spots = stargaze(whereabouts, radius, direction, profile=args.profile)
+        SessionFactory.get_instance().close()
+        for spot in spots:
+            print(spot)
+    if args.profile:
+        _profile()
+
+
+def _profile() -> None:
+    """Prints recorded timings and counters, and captured plans."""
+    print(file=sys.stderr)
+    print(metrics.registry.report(), file=sys.stderr)
+    for plan in metrics.registry.plans:
+        print(file=sys.stderr)
+        print(f'{plan["query"]} {plan["parameters"]}', file=sys.stderr)
+        print(plan['plan'], file=sys.stderr)
+
+
+def _report(done: int, total: int, elapsed: float) -> None:
+    """Prints progress and throughput of a tile import."""
+    rate = done / elapsed if elapsed else 0.0
+    eta = (total - done) / rate if rate else float('inf')
+    print(
+        f'{done}/{total} tiles ({done / total:.1%}), '
+        f'{rate * 60:.1f} tiles/min, {eta / 60:.0f} min remaining',
+        flush=True
+    )
+
+
+def seed_main(argv) -> None:
+    parser = ArgumentParser(
+        prog='stargaze seed',
+        description=\
+            'imports all data of a region ahead of searches, run it again '\
+            'to resume an interrupted run'
+    )
+    area = parser.add_mutually_exclusive_group(required=True)
+    area.add_argument(
+        '--bbox', metavar='south,west,north,east',
+        help='bounding box of the region, e.g. "49.9,14.2,50.2,14.7"'
+    )
+    area.add_argument(
+        '--polygon', metavar='file',
+        help='file with the WKT geometry of the region in WGS84'
+    )
+    args = parser.parse_args(argv)
+    if args.bbox:
+        region = parse_bbox(args.bbox)
+    else:
+        with open(args.polygon) as polygon_file:
+            region = polygon_file.read().strip()
+
+    try:
+        imported = seed(region, progress=_report)
+    finally:
+        SessionFactory.get_instance().close()
+    print(f'imported {imported} tiles')
+
+
+def import_main(argv) -> None:
+    parser = ArgumentParser(
+        prog='stargaze import',
+        description=\
+            'imports OSM data of a local extract and relief of the tiles it '\
+            'covers'
+    )
+    parser.add_argument(
+        'extract',
+        help='OSM XML extract, optionally compressed, e.g. "region.osm.bz2"'
+    )
+    args = parser.parse_args(argv)
+    try:
+        imported = import_extract(args.extract, progress=_report)
+    finally:
+        SessionFactory.get_instance().close()
+    print(f'imported {imported} tiles')
+
+
+def refresh_main(argv) -> None:
+    parser = ArgumentParser(
+        prog='stargaze refresh',
+        description='updates data of tiles imported long ago with OSM changes'
+    )
+    parser.add_argument(
+        '--age', metavar='duration',
+        help='age of tiles to be refreshed, e.g. "7 days"'
+    )
+    parser.add_argument(
+        '--limit', type=int, metavar='tiles',
+        help='maximum number of tiles refreshed in a run'
+    )
+    parser.add_argument(
+        '--every', metavar='duration',
+        help='keep running and refresh tiles periodically, e.g. "1 hour"'
+    )
+    args = parser.parse_args(argv)
+    age = args.age and parse_duration(args.age)
+    try:
+        while True:
+            print(f'refreshed {refresh(age, args.limit)} tiles', flush=True)
+            if not args.every:
+                break
+            time.sleep(parse_duration(args.every))
+    finally:
+        SessionFactory.get_instance().close()
+
+
+def search_many(path: str,
+                radius: float,
+                direction: float | None,
+                profile: bool = False) -> None:
+    """Searches around all whereabouts in the file, printing spots of each."""
+    descriptions = {}
+    with open(path) as origins_file:
+        for line in origins_file:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                descriptions.setdefault(find_coordinates(line), []).append(line)
+    try:
+        for origin, spots in stargaze_many(
+            descriptions, radius, direction, profile
+        ):
+            for description in descriptions[origin]:
+                print(f'{description}:')
+                for spot in spots:
+                    print(f'    {spot}')
+    finally:
+        SessionFactory.get_instance().close()
 
 
 if __name__ == '__main__':
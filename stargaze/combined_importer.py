@@ -0,0 +1,112 @@
+from datetime import datetime
+
+from stargaze import overpass
+from stargaze.base_importer import BaseImporter
+from stargaze.commons import BoundingBox
+from stargaze.land_importer import LandImporter
+from stargaze.residential_area_importer import ResidentialAreaImporter
+from stargaze.road_importer import RoadImporter
+from stargaze.sessions import SessionFactory
+
+
+class CombinedImporter(BaseImporter):
+    """Importer running several OverpassAPI importers with a single request.
+
+    The selectors of all the given importers are united into one query, so the
+    features for all of them are downloaded and parsed only once. Each element
+    of the response is then handed over to the `transform` of every importer
+    having a selector which matches the element, and each importer loads its
+    own part of the data.
+
+    The time of the OSM data every fetched extract was generated from is kept
+    by the bounds it was fetched for until it is taken by `source_timestamp`.
+    Features changed since a given time can be fetched with `newer`, and `ids`
+    fetches identifiers of the features selected by each importer, so that the
+    ones which no longer exist, or are no longer selected by the importer they
+    were loaded by, can be pruned."""
+
+    source = 'overpass'
+
+    def __init__(self,
+                 importers: list[BaseImporter],
+                 endpoint: str | None = None,
+                 stream: bool = False):
+        self._importers = importers
+        self._endpoint = endpoint
+        self.stream = stream
+        self._timestamps = {}
+
+    @property
+    def selectors(self) -> list[overpass.Selector]:
+        return [
+            selector
+            for importer in self._importers
+            for selector in importer.selectors
+        ]
+
+    def fetch(self, bounds: BoundingBox, newer: datetime | None = None):
+        overpass_query = overpass.query(self.selectors, bounds, newer=newer)
+        extract = overpass.fetch(
+            overpass_query,
+            endpoint=self._endpoint,
+            stream=self.stream,
+            compact=True
+        )
+        self._timestamps[bounds] = overpass.timestamp(extract)
+        return extract
+
+    def source_timestamp(self, bounds: BoundingBox) -> datetime | None:
+        """Returns and forgets the data time of the extract of the bounds."""
+        return self._timestamps.pop(bounds, None)
+
+    def ids(self, bounds: BoundingBox) -> list[dict[str, set[int]]]:
+        """Returns identifiers of features selected within the bounds.
+
+        Identifiers are fetched separately for every importer, in the order of
+        the importers, see `overpass.fetch_ids`."""
+        return [
+            overpass.fetch_ids(
+                overpass.query(importer.selectors, bounds, ids=True),
+                endpoint=self._endpoint
+            )
+            for importer in self._importers
+        ]
+
+    def batches(self, extract):
+        return overpass.batches(extract)
+
+    def transform(self, extract):
+        elements = [[] for _ in self._importers]
+        for feature in extract.elements:
+            for importer, selected in zip(self._importers, elements):
+                if any(
+                    selector.matches(feature) for selector in importer.selectors
+                ):
+                    selected.append(feature)
+        return [
+            importer.transform(extract.model_copy(update={'elements': selected}))
+            for importer, selected in zip(self._importers, elements)
+        ]
+
+    def load(self, data, session):
+        for importer, importer_data in zip(self._importers, data):
+            importer.load(importer_data, session)
+
+    def prune(self, bounds: BoundingBox, refs, session):
+        """Prunes every importer by its own identifiers returned by `ids`."""
+        for importer, importer_refs in zip(self._importers, refs):
+            importer.prune(bounds, importer_refs, session)
+
+
+def main():
+    importer = CombinedImporter(
+        [LandImporter(), ResidentialAreaImporter(), RoadImporter()]
+    )
+    bounds = BoundingBox(minlat=49.98, minlon=19.88, maxlat=50.02, maxlon=19.92)
+    with SessionFactory.get_instance() as factory:
+        with factory.session_scope() as session:
+            importer.run(bounds, session)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,7 @@
+from array import array
+from collections.abc import Iterable, Sequence
 from dataclasses import dataclass
+from typing import overload
 
 
 @dataclass(frozen=True, kw_only=True)
@@ -32,4 +35,74 @@ class Coordinates:
         return f'({self.lat}, {self.lon})'
 
 
-__all__ = ['BoundingBox', 'Coordinates']
+class Path(Sequence[Coordinates]):
+    """Compact sequence of coordinates.
+
+    The vertices are stored as consecutive pairs of longitude and latitude in a
+    slice of a flat `array('d')`, which may be shared by many paths, e.g. by all
+    the geometries of a single Overpass response. Indexing and iteration produce
+    `Coordinates`, so a path can be used wherever a list of coordinates is
+    expected, but bulk operations work directly on the buffer."""
+
+    __slots__ = ('_buffer', '_start', '_stop')
+
+    def __init__(self, buffer: array, start: int = 0, stop: int | None = None):
+        self._buffer = buffer
+        self._start = start
+        self._stop = len(buffer) if stop is None else stop
+
+    @classmethod
+    def extend(cls, buffer: array, vertices: Iterable[dict]) -> 'Path':
+        """Appends vertices given as mappings to the buffer and returns them."""
+        start = len(buffer)
+        for vertex in vertices:
+            buffer.append(vertex['lon'])
+            buffer.append(vertex['lat'])
+        return cls(buffer, start, len(buffer))
+
+    def values(self) -> array:
+        """Returns a copy of the flat buffer slice of this path."""
+        return self._buffer[self._start:self._stop]
+
+    def is_closed(self) -> bool:
+        """Returns whether the first and the last vertex are equal."""
+        buffer, start, stop = self._buffer, self._start, self._stop
+        return (
+            stop - start >= 2
+            and buffer[start] == buffer[stop - 2]
+            and buffer[start + 1] == buffer[stop - 1]
+        )
+
+    def __len__(self):
+        return (self._stop - self._start) // 2
+
+    @overload
+    def __getitem__(self, index: int) -> Coordinates: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> 'Path': ...
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            # contiguous slices share the buffer, others are copied
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                return Path(
+                    self._buffer,
+                    self._start + 2 * start,
+                    self._start + 2 * max(stop, start)
+                )
+            buffer = array('d')
+            for position in range(start, stop, step):
+                offset = self._start + 2 * position
+                buffer.extend(self._buffer[offset:offset + 2])
+            return Path(buffer)
+        if not -len(self) <= index < len(self):
+            raise IndexError('path index out of range')
+        offset = self._start + 2 * (index % len(self))
+        return Coordinates(
+            lat=self._buffer[offset + 1], lon=self._buffer[offset]
+        )
+
+
+__all__ = ['BoundingBox', 'Coordinates', 'Path']
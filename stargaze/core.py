@@ -1,31 +1,79 @@
 """Core application logic."""
 
+from collections.abc import Iterable, Iterator
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from functools import partial
 from textwrap import dedent
+import time
+import weakref
 
 import importlib
 import psycopg2
 
+from stargaze import coverage
+from stargaze import metrics
+from stargaze import search_cache
+from stargaze import tile_claims
 from stargaze import wkt
+from stargaze.combined_importer import CombinedImporter
 from stargaze.commons import BoundingBox, Coordinates
+from stargaze.dem_store import DemStore
+from stargaze.executor import ImportExecutor
+from stargaze.extract_importer import ExtractImporter
 from stargaze.land_importer import LandImporter
+from stargaze.refresher import Refresher
 from stargaze.relief_importer import ReliefImporter
 from stargaze.residential_area_importer import ResidentialAreaImporter
 from stargaze.road_importer import RoadImporter
 from stargaze.sessions import SessionFactory
+from stargaze.settings import settings
 
 _session_factory = SessionFactory.get_instance()
 
-_importers = [
-    LandImporter(), ReliefImporter(), ResidentialAreaImporter(), RoadImporter()
-]
+_osm_importer = CombinedImporter(
+    [LandImporter(), ResidentialAreaImporter(), RoadImporter()],
+    endpoint=settings['overpass']['endpoint'] or None,
+    stream=settings['overpass']['stream']
+)
+
+_relief_importer = ReliefImporter(
+    store=DemStore.from_settings(),
+    offline=settings['relief']['store']['offline'],
+    endpoint=settings['relief']['endpoint'] or None
+)
+
+_importers = [_osm_importer, _relief_importer]
+
+_executor = ImportExecutor(_session_factory, _importers)
+
+# imports relief of tiles whose OSM data comes from a local extract
+_relief_executor = ImportExecutor(_session_factory, [_relief_importer])
+
+_hillshade = settings['hillshade']
+_light_pollution = settings['light_pollution']
+_claims = settings['claims']
+_metrics = settings['metrics']
 
 _scripts = importlib.resources.files('stargaze.resources.scripts')
 
 with open(_scripts / 'missing_tiles.sql', 'r') as file:
     _missing_tiles_query = file.read();
 
+with open(_scripts / 'seed_tiles.sql', 'r') as file:
+    _seed_tiles_query = file.read()
+
+_prepare_search = (
+    'prepare stargaze_search (text, float, float, float, integer, integer) as '
+    'select lon, lat from stargaze_search('
+    'ST_GeomFromText($1, 4326)::geography, $2, $3, $4, $5, $6)'
+)
 
+# connections of the pool on which the search statement has been prepared
+_prepared = weakref.WeakSet()
+
+
+@metrics.span('identify_missing_tiles')
 def identify_missing_tiles(origin: Coordinates, radius: float) -> list[
     BoundingBox]:
     """Returns a list of missing tiles for a given search area.
@@ -35,50 +83,221 @@ def identify_missing_tiles(origin: Coordinates, radius: float) -> list[
     are covered by the desired search area, that is needed for the query, but
     are not present in the database and hence have to be downloaded."""
 
-    with _session_factory.session_scope() as session:
-        with session.cursor() as cursor:
-            cursor.execute(
-                _missing_tiles_query,
-                {'origin': str(wkt.Point(origin)), 'radius': radius}
-            )
-            tiles = cursor.fetchall()
-    return tiles
+    with _session_factory.session_scope(readonly=True) as session:
+        return _missing_tiles(session, origin, radius)
+
+
+def _missing_tiles(session, origin: Coordinates, radius: float):
+    with session.cursor() as cursor:
+        cursor.execute(
+            _missing_tiles_query,
+            {'origin': str(wkt.Point(origin)), 'radius': radius}
+        )
+        return cursor.fetchall()
+
+
+@metrics.span('import_tiles')
+def import_tiles(missing_tiles,
+                 confirmed=None,
+                 executor: ImportExecutor | None = None,
+                 source_timestamp: datetime | None = None,
+                 wait: float | None = _claims['wait'],
+                 light: bool = True) -> None:
+    """Runs all importers on the missing tiles if any provided.
 
+    The tiles are grouped into rectangular blocks by `coverage.plan` and every
+    importer is run on each block separately, so that tiles already present in
+    the database are not downloaded again. The importers run concurrently and
+    each block is confirmed as soon as all importers have finished with it, and
+    passed to `confirmed` if given. A different `executor` may be given to run
+    only some of the importers, along with the `source_timestamp` of the data
+    imported otherwise. Light pollution is left to the caller when `light` is
+    false, see `confirm_tile_import`.
 
-def import_tiles(missing_tiles) -> None:
-    """Runs all importers on the extent of the tiles if any provided."""
+    Only tiles claimed by this call are imported, tiles being imported by
+    another worker are waited for until they are present, or until their claim
+    expires and they can be claimed here, see `tile_claims`. Claims of this
+    call are renewed while it imports. `TimeoutError` is raised when tiles
+    imported elsewhere are still missing after `wait` seconds, unless it is
+    `None`."""
     if not missing_tiles:
         print('nothing to be imported')
         return
 
-    south = []
-    west = []
-    north = []
-    east = []
-    for tile in missing_tiles:
-        south.append(tile[1])
-        west.append(tile[2])
-        north.append(tile[3])
-        east.append(tile[4])
-    bounds = BoundingBox(
-        minlat=min(south),
-        minlon=min(west),
-        maxlat=max(north),
-        maxlon=max(east)
-    )
-    for importer in _importers:
+    owner = tile_claims.owner()
+    waiting = {tile[0]: tile for tile in missing_tiles}
+    deadline = None if wait is None else time.monotonic() + wait
+    while waiting:
         with _session_factory.session_scope() as session:
-            print(f'running {type(importer).__qualname__} on {bounds}')
-            importer.run(bounds, session)
+            claimed = tile_claims.claim(
+                session, list(waiting), owner, _claims['expire']
+            )
+        if claimed:
+            try:
+                groups = coverage.plan(
+                    [tile for geohash, tile in waiting.items()
+                     if geohash in claimed]
+                )
+                with tile_claims.heartbeat(
+                    _session_factory, owner, _claims['heartbeat']
+                ):
+                    for group in (executor or _executor).run(groups):
+                        confirm_tile_import(
+                            group.tiles,
+                            source_timestamp
+                            or _osm_importer.source_timestamp(group.bounds),
+                            light=light
+                        )
+                        if confirmed is not None:
+                            confirmed(group)
+            except BaseException:
+                with _session_factory.session_scope() as session:
+                    tile_claims.release(session, owner)
+                raise
+        waiting = {
+            geohash: tile for geohash, tile in waiting.items()
+            if geohash not in claimed
+        }
+        if waiting:
+            with _session_factory.session_scope() as session:
+                absent = tile_claims.absent(session, list(waiting))
+            waiting = {
+                geohash: tile for geohash, tile in waiting.items()
+                if geohash in absent
+            }
+            if waiting:
+                if deadline is not None and time.monotonic() > deadline:
+                    raise TimeoutError(
+                        f'{len(waiting)} tiles imported elsewhere are still '
+                        f'missing after {wait} seconds'
+                    )
+                print(f'waiting for {len(waiting)} tiles imported elsewhere')
+                time.sleep(_claims['poll'])
+
+
+def seed(area, progress=None) -> int:
+    """Imports all tiles of the area, a WKT geometry, which are not present yet.
+
+    Tiles are confirmed group by group as they are imported, so the table of
+    present tiles is the checkpoint of seeding: an interrupted run picks up
+    where it stopped when started again on the same area. `progress` is called
+    after every group with the number of tiles imported so far, the total and
+    the elapsed time in seconds. Light pollution, which reaches over many
+    groups, is built once at the end, for all tiles lacking it, including the
+    ones of interrupted runs. Returns the number of imported tiles."""
+    with _session_factory.session_scope() as session:
+        with session.cursor() as cursor:
+            cursor.execute(_seed_tiles_query, {'area': area})
+            missing_tiles = cursor.fetchall()
+    if not missing_tiles:
+        return 0
+    start = time.monotonic()
+    done = 0
+
+    def confirmed(group: coverage.TileGroup) -> None:
+        nonlocal done
+        done += len(group.tiles)
+        if progress is not None:
+            progress(done, len(missing_tiles), time.monotonic() - start)
+
+    import_tiles(missing_tiles, confirmed, wait=None, light=False)
+    build_missing_light_tiles()
+    return done
+
+
+def import_extract(path, progress=None) -> int:
+    """Imports OSM data of a local extract file and marks its tiles imported.
+
+    All features of the extract are loaded at once, see `ExtractImporter`, then
+    relief of the tiles lying entirely within the bounds of the extract is
+    imported and the tiles are confirmed, so an air-gapped host needs the DEM
+    store to be filled. `progress` is called like by `seed`, and light pollution
+    is built at the end like by it. Returns the number of imported tiles."""
+    importer = ExtractImporter(path, _osm_importer)
+    with _session_factory.session_scope() as session:
+        importer.run(None, session)
+    bounds = importer.bounds
+    if bounds is None:
+        raise ValueError(f'bounds of the extract {path} are not known')
+    area = wkt.Polygon([
+        Coordinates(lat=bounds.minlat, lon=bounds.minlon),
+        Coordinates(lat=bounds.minlat, lon=bounds.maxlon),
+        Coordinates(lat=bounds.maxlat, lon=bounds.maxlon),
+        Coordinates(lat=bounds.maxlat, lon=bounds.minlon),
+        Coordinates(lat=bounds.minlat, lon=bounds.minlon)
+    ])
+    with _session_factory.session_scope() as session:
+        with session.cursor() as cursor:
+            cursor.execute(_seed_tiles_query, {'area': str(area)})
+            tiles = [
+                tile for tile in cursor.fetchall()
+                if bounds.minlat <= tile[1] and tile[3] <= bounds.maxlat
+                and bounds.minlon <= tile[2] and tile[4] <= bounds.maxlon
+            ]
+    start = time.monotonic()
+    done = 0
+
+    def confirmed(group: coverage.TileGroup) -> None:
+        nonlocal done
+        done += len(group.tiles)
+        if progress is not None:
+            progress(done, len(tiles), time.monotonic() - start)
+
+    import_tiles(
+        tiles, confirmed, _relief_executor, importer.timestamp, wait=None,
+        light=False
+    )
+    build_missing_light_tiles()
+    return done
+
+
+def build_missing_light_tiles() -> None:
+    """Builds light pollution of the tiles which have none yet.
+
+    Tiles within reach of the residential areas of those tiles are rebuilt as
+    well, see `build_light_tiles` in the schema."""
+    with _session_factory.session_scope() as session:
+        with session.cursor() as cursor:
+            cursor.execute(
+                'select build_light_tiles(array('
+                'select tiles.geohash::text '
+                'from tiles left join light_tiles using (geohash) '
+                'where light_tiles.geohash is null), %s, %s)',
+                (_light_pollution['reach'], _light_pollution['resolution'])
+            )
+    _session_factory.mark_written()
+
 
-    confirm_tile_import(missing_tiles)
+@metrics.span('confirm_tile_import')
+def confirm_tile_import(tiles,
+                        source_timestamp: datetime | None = None,
+                        relief: bool = True,
+                        light: bool = True) -> None:
+    """Add the tiles to the table of present tiles
 
+    Masks of the tiles and their neighbours are built from the imported roads
+    and land, so is their hillshade if it is precomputed, light pollution of
+    the tiles within its reach is updated with the new residential areas, and
+    cached results of searches overlapping with the tiles are dropped, since
+    they were computed without the data of these tiles.
 
-def confirm_tile_import(tiles) -> None:
-    """Add the tiles to the table of present tiles"""
-    _insert_tiles = 'insert into tiles (geohash, bbox) values(%s, %s::box2d)'
+    The tiles are stamped with the time of the import and `source_timestamp`,
+    the time of the OSM data they were imported from. Tiles already present,
+    e.g. refreshed ones, are stamped again. Hillshade is rebuilt only if
+    `relief` was imported as well, light pollution only if `light` is true,
+    otherwise it is up to the caller, see `build_missing_light_tiles`."""
+    _insert_tiles = (
+        'insert into tiles (geohash, bbox, source_timestamp) '
+        'values(%s, %s::box2d, %s) '
+        'on conflict (geohash) do update set '
+        'imported = now(), source_timestamp = excluded.source_timestamp'
+    )
     new_rows = [
-        (geohash, str(wkt.Box(south=south, west=west, north=north, east=east)))
+        (
+            geohash,
+            str(wkt.Box(south=south, west=west, north=north, east=east)),
+            source_timestamp
+        )
         for geohash, south, west, north, east in tiles
     ]
     with _session_factory.session_scope() as session:
@@ -87,31 +306,215 @@ def confirm_tile_import(tiles) -> None:
                 _insert_tiles,
                 new_rows
             )
+            geohashes = [geohash for geohash, *_ in tiles]
+            cursor.execute(
+                'delete from tile_imports where geohash = any(%s)', (geohashes,)
+            )
+            cursor.execute('select build_tile_masks(%s)', (geohashes,))
+            if light:
+                cursor.execute(
+                    'select build_light_tiles(%s, %s, %s)',
+                    (
+                        geohashes,
+                        _light_pollution['reach'],
+                        _light_pollution['resolution']
+                    )
+                )
+            if relief and _hillshade['precomputed']:
+                cursor.execute(
+                    'select build_hillshade_tiles(%s, %s, %s)',
+                    (geohashes, _hillshade['sectors'], _hillshade['altitude'])
+                )
+        search_cache.invalidate(session, tiles)
+    _session_factory.mark_written()
+
+
+def refresh(age: float | None = None, limit: int | None = None) -> int:
+    """Refreshes OSM data of tiles imported more than `age` seconds ago.
+
+    Returns the number of refreshed tiles, see `Refresher`."""
+    refresher = Refresher(
+        _session_factory,
+        _osm_importer,
+        partial(confirm_tile_import, relief=False)
+    )
+    return refresher.run(age, limit)
+
+
+def _sector(azimuth: float | None) -> int | None:
+    """Returns the precomputed hillshade sector nearest to the azimuth."""
+    if azimuth is None or not _hillshade['precomputed']:
+        return None
+    sectors = _hillshade['sectors']
+    return round(azimuth * sectors / 360) % sectors
 
 
+def _search(session,
+            origin: Coordinates,
+            radius: float,
+            azimuth: float | None,
+            profile: bool = False):
+    """Runs the search function through a statement prepared on the session.
+
+    When plan capture is enabled and the search takes longer than the
+    threshold, or when `profile` is true, it is run again under
+    `explain (analyze, buffers)` and its plan is kept in the metrics
+    registry."""
+    parameters = (
+        str(wkt.Point(origin)),
+        radius,
+        azimuth,
+        _hillshade['altitude'],
+        _sector(azimuth),
+        settings['search']['spots']
+    )
+    with session.cursor() as cursor:
+        if session not in _prepared:
+            cursor.execute(_prepare_search)
+            _prepared.add(session)
+        start = time.perf_counter()
+        with metrics.span('search'):
+            cursor.execute(
+                'execute stargaze_search (%s, %s, %s, %s, %s, %s)', parameters
+            )
+            spots = [Coordinates(lat=lat, lon=lon) for lon, lat in cursor]
+        elapsed = time.perf_counter() - start
+        if profile or (
+            _metrics['explain'] and elapsed >= _metrics['explain_threshold']
+        ):
+            cursor.execute(
+                'explain (analyze, buffers) '
+                'execute stargaze_search (%s, %s, %s, %s, %s, %s)',
+                parameters
+            )
+            metrics.registry.capture_plan(
+                'stargaze_search',
+                dict(zip(
+                    ('origin', 'radius', 'azimuth', 'altitude', 'sector',
+                     'spots'),
+                    parameters
+                )),
+                '\n'.join(line for line, in cursor)
+            )
+    return spots
+
+
+@metrics.span('stargaze')
 def stargaze(origin: Coordinates,
              radius: float,
-             azimuth: float) -> list[Coordinates]:
+             azimuth: float,
+             progress=None,
+             profile: bool = False) -> list[Coordinates]:
+    """Searches for spots around the origin, importing missing tiles first.
+
+    `progress` is called with the stage of the search: 'importing' along with
+    the number of tiles imported so far and the number of missing ones, after
+    every group of tiles, then 'searching' when the query starts. When
+    `profile` is true, the search bypasses the cache and its plan is captured,
+    see `metrics.Registry.capture_plan`."""
+    cached = settings['search_cache']['enabled'] and not profile
+    if cached:
+        cache_key = search_cache.key(origin, radius, azimuth)
+        with _session_factory.session_scope(readonly=True) as session:
+            spots = search_cache.get(session, cache_key)
+        if spots is not None:
+            return spots
     missing_tiles = identify_missing_tiles(origin, radius)
     print(f'there are {len(missing_tiles)} missing tiles')
-    import_tiles(missing_tiles)
-    with open(_scripts / 'stargaze.sql') as file:
-        stargaze_query = file.read()
-    with _session_factory.session_scope() as session:
-        with session.cursor() as cursor:
-            cursor.execute(
-                stargaze_query,
-                {'origin': str(wkt.Point(origin)),
-                 'radius': radius,
-                 'azimuth': azimuth,
-                 'altitude': 45}
+    done = 0
+
+    def confirmed(group: coverage.TileGroup) -> None:
+        nonlocal done
+        done += len(group.tiles)
+        progress('importing', done, len(missing_tiles))
+
+    if progress is not None and missing_tiles:
+        progress('importing', 0, len(missing_tiles))
+    import_tiles(missing_tiles, confirmed if progress is not None else None)
+    if progress is not None:
+        progress('searching')
+    return _evaluate(
+        origin, radius, azimuth, cache_key if cached else None, profile
+    )
+
+
+def _evaluate(origin: Coordinates,
+              radius: float,
+              azimuth: float | None,
+              cache_key: str | None,
+              profile: bool = False) -> list[Coordinates]:
+    """Searches for spots in imported tiles and caches them if given a key."""
+    with _session_factory.session_scope(readonly=True) as session:
+        # taken before the search, so that tiles imported in between make
+        # the cached result outdated rather than the other way round
+        coverage = cache_key and search_cache.version(session, origin, radius)
+        spots = _search(session, origin, radius, azimuth, profile)
+    if cache_key is not None:
+        with _session_factory.session_scope() as session:
+            search_cache.put(
+                session, cache_key, origin, radius, spots, coverage
             )
-            spots = [Coordinates(lat=lat, lon=lon) for lon, lat in cursor]
-        session.commit()
     return spots
 
 
-__all__ = ['stargaze']
+def stargaze_many(
+        origins: Iterable[Coordinates],
+        radius: float,
+        azimuth: float | None,
+        profile: bool = False
+) -> Iterator[tuple[Coordinates, list[Coordinates]]]:
+    """Searches for spots around many origins.
+
+    Yields pairs of an origin and its spots as the searches finish, cached
+    results first. Missing tiles of all the search areas are identified in a
+    single session and imported once, then the searches run in parallel over
+    the connection pool. Equal origins are searched only once. `profile` is
+    handled like by `stargaze`."""
+    cached = settings['search_cache']['enabled'] and not profile
+    searches = {}
+    for origin in origins:
+        searches.setdefault((origin, radius, azimuth), []).append(origin)
+
+    pending = {}
+    hits = {}
+    with _session_factory.session_scope(readonly=True) as session:
+        for params in searches:
+            cache_key = search_cache.key(*params) if cached else None
+            spots = cache_key and search_cache.get(session, cache_key)
+            if spots is None:
+                pending[params] = cache_key
+            else:
+                hits[params] = spots
+    for params, spots in hits.items():
+        for origin in searches[params]:
+            yield origin, spots
+    if not pending:
+        return
+
+    missing_tiles = {}
+    with _session_factory.session_scope(readonly=True) as session:
+        for origin, search_radius, _ in pending:
+            for tile in _missing_tiles(session, origin, search_radius):
+                missing_tiles.setdefault(tile[0], tile)
+    print(f'there are {len(missing_tiles)} missing tiles')
+    import_tiles(list(missing_tiles.values()))
+
+    with ThreadPoolExecutor(settings['search']['workers']) as executor:
+        futures = {
+            executor.submit(_evaluate, *params, cache_key, profile): params
+            for params, cache_key in pending.items()
+        }
+        try:
+            for future in as_completed(futures):
+                spots = future.result()
+                for origin in searches[futures[future]]:
+                    yield origin, spots
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+__all__ = ['import_extract', 'refresh', 'seed', 'stargaze', 'stargaze_many']
 
 
 def main():
@@ -0,0 +1,125 @@
+"""Coverage planning.
+
+Missing tiles reported by `core.identify_missing_tiles` are scattered over the
+search area, so importing their common bounding box would download plenty of
+data which is already present in the database. This module groups the missing
+tiles into a small number of tight rectangles, each of which can be imported
+with a single request per importer."""
+
+
+from dataclasses import dataclass
+import math
+
+from stargaze.commons import BoundingBox
+from stargaze.settings import settings
+
+
+# side of a geohash tile of precision 5, the same as in `missing_tiles.sql`
+_tile_size = 180 / 2 ** 12
+
+_base32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+@dataclass(frozen=True, kw_only=True)
+class TileGroup:
+    bounds: BoundingBox
+    tiles: tuple
+
+
+def _index(degrees: float) -> int:
+    """Returns the position of a tile edge on the tile grid."""
+    return round(degrees / _tile_size)
+
+
+def geohash(lat: float, lon: float, precision: int = 5) -> str:
+    """Returns the geohash of the point with the given precision."""
+    bounds = [[-90.0, 90.0], [-180.0, 180.0]]
+    value = [lat, lon]
+    characters = []
+    bits = 0
+    # bits alternate between longitude and latitude, starting with longitude
+    for bit in range(5 * precision):
+        axis = 1 - bit % 2
+        low, high = bounds[axis]
+        middle = (low + high) / 2
+        bits <<= 1
+        if value[axis] >= middle:
+            bits |= 1
+            bounds[axis][0] = middle
+        else:
+            bounds[axis][1] = middle
+        if bit % 5 == 4:
+            characters.append(_base32[bits])
+            bits = 0
+    return ''.join(characters)
+
+
+def tiles(bounds: BoundingBox) -> list[tuple]:
+    """Returns the tiles overlapping with the bounds.
+
+    The tiles are given in the same form as rows of `missing_tiles.sql`, that is
+    tuples of geohash, south, west, north and east."""
+
+    return [
+        (
+            geohash((row + 0.5) * _tile_size, (col + 0.5) * _tile_size),
+            row * _tile_size,
+            col * _tile_size,
+            (row + 1) * _tile_size,
+            (col + 1) * _tile_size
+        )
+        for row in range(
+            math.floor(bounds.minlat / _tile_size),
+            math.ceil(bounds.maxlat / _tile_size)
+        )
+        for col in range(
+            math.floor(bounds.minlon / _tile_size),
+            math.ceil(bounds.maxlon / _tile_size)
+        )
+    ]
+
+
+def plan(tiles, max_tiles: int | None = None) -> list[TileGroup]:
+    """Groups tiles into rectangular blocks of at most `max_tiles` tiles.
+
+    Tiles are given as rows of `missing_tiles.sql`, that is tuples of geohash,
+    south, west, north and east. The grid is scanned row by row, starting from
+    the south-western corner, and every tile not yet assigned to a group starts
+    a new group, which is greedily extended first eastwards and then northwards
+    as long as it consists of tiles from the input only and does not exceed the
+    size cap. The groups are disjoint and together cover exactly the input."""
+
+    max_tiles = max_tiles or settings['coverage']['max_tiles']
+    if max_tiles < 1:
+        raise ValueError(f'max_tiles must be positive, but {max_tiles} given')
+    cells = {(_index(tile[1]), _index(tile[2])): tile for tile in tiles}
+    groups = []
+    for row, col in sorted(cells):
+        if (row, col) not in cells:
+            continue
+        width = 1
+        while width < max_tiles and (row, col + width) in cells:
+            width += 1
+        height = 1
+        while (height + 1) * width <= max_tiles and all(
+            (row + height, c) in cells for c in range(col, col + width)
+        ):
+            height += 1
+        members = tuple(
+            cells.pop((r, c))
+            for r in range(row, row + height)
+            for c in range(col, col + width)
+        )
+        groups.append(TileGroup(
+            bounds=BoundingBox(
+                minlat=min(tile[1] for tile in members),
+                minlon=min(tile[2] for tile in members),
+                maxlat=max(tile[3] for tile in members),
+                maxlon=max(tile[4] for tile in members)
+            ),
+            tiles=members
+        ))
+    return groups
+
+
+__all__ = ['TileGroup', 'geohash', 'plan', 'tiles']
@@ -0,0 +1,146 @@
+"""Local store of digital elevation model rasters.
+
+Rasters downloaded from OpenTopography are kept on disk, so that relief can be
+imported again, e.g. after the database has been rebuilt, without using the API
+quota. The files are content-addressed, that is named by the SHA-256 digest of
+their content, and an SQLite index next to them maps every geohash tile to the
+raster covering it. The total size of the store is capped, and the least
+recently used rasters are evicted first."""
+
+
+from contextlib import contextmanager
+import hashlib
+import os
+from pathlib import Path
+import sqlite3
+import time
+
+import platformdirs
+
+from stargaze.settings import settings
+
+
+class DemStore:
+
+    _schema = """
+        create table if not exists rasters (
+            digest text primary key,
+            size integer not null,
+            accessed real not null
+        );
+        create table if not exists tiles (
+            geohash text primary key,
+            digest text not null references rasters(digest)
+        );
+        create index if not exists tiles_digest on tiles(digest);"""
+
+    def __init__(self, directory: str | os.PathLike, max_size: int):
+        self._directory = Path(directory)
+        self._directory.mkdir(parents=True, exist_ok=True)
+        self._max_size = max_size
+        with self._connect() as connection:
+            connection.executescript(self._schema)
+
+    @classmethod
+    def from_settings(cls):
+        """Returns the store configured in settings, or None if disabled."""
+        config = settings['relief']['store']
+        if not config['enabled']:
+            return None
+        directory = config['directory'] or platformdirs.user_cache_dir(
+            'stargaze'
+        )
+        return cls(Path(directory) / 'dem', config['max_size'] * 2 ** 20)
+
+    @contextmanager
+    def _connect(self):
+        """Context manager for a transaction on the index."""
+        # several processes may share the store, hence the generous timeout
+        connection = sqlite3.connect(self._directory / 'index.sqlite', timeout=60)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def _path(self, digest: str) -> Path:
+        return self._directory / f'{digest}.tif'
+
+    def lookup(self, geohashes: list[str]) -> list[Path] | None:
+        """Returns rasters covering all the tiles, or None if any is missing."""
+        with self._connect() as connection:
+            rows = connection.execute(
+                'select geohash, digest from tiles where geohash in ({})'
+                .format(', '.join('?' * len(geohashes))),
+                geohashes
+            ).fetchall()
+            if len(rows) < len(set(geohashes)):
+                return None
+            digests = sorted({digest for _, digest in rows})
+            connection.executemany(
+                'update rasters set accessed = ? where digest = ?',
+                [(time.time(), digest) for digest in digests]
+            )
+        paths = [self._path(digest) for digest in digests]
+        if not all(path.exists() for path in paths):
+            return None
+        return paths
+
+    def add(self, raster: Path, geohashes: list[str]) -> Path:
+        """Moves the raster file into the store and returns its new path.
+
+        The raster is registered as covering the given tiles, replacing rasters
+        previously registered for them."""
+
+        digest = hashlib.sha256()
+        with open(raster, 'rb') as raster_file:
+            while chunk := raster_file.read(1 << 20):
+                digest.update(chunk)
+        digest = digest.hexdigest()
+        path = self._path(digest)
+        os.replace(raster, path)
+        with self._connect() as connection:
+            connection.execute(
+                'insert into rasters (digest, size, accessed) values (?, ?, ?) '
+                'on conflict (digest) do update set accessed = excluded.accessed',
+                (digest, path.stat().st_size, time.time())
+            )
+            connection.executemany(
+                'insert or replace into tiles (geohash, digest) values (?, ?)',
+                [(geohash, digest) for geohash in geohashes]
+            )
+            self._evict(connection, keep=digest)
+        return path
+
+    def _evict(self, connection: sqlite3.Connection, keep: str) -> None:
+        """Removes unused and then least recently used rasters over the cap.
+
+        The raster with the digest `keep` is never removed."""
+        unused = connection.execute(
+            'select digest from rasters '
+            'where digest not in (select digest from tiles)'
+        ).fetchall()
+        total = connection.execute(
+            'select coalesce(sum(size), 0) from rasters '
+            'where digest in (select digest from tiles)'
+        ).fetchone()[0]
+        candidates = connection.execute(
+            'select digest, size from rasters '
+            'where digest in (select digest from tiles) '
+            'order by accessed'
+        ).fetchall()
+        evicted = [digest for digest, in unused]
+        for digest, size in candidates:
+            if total <= self._max_size:
+                break
+            if digest == keep:
+                continue
+            evicted.append(digest)
+            total -= size
+        for digest in evicted:
+            connection.execute('delete from tiles where digest = ?', (digest,))
+            connection.execute('delete from rasters where digest = ?', (digest,))
+            self._path(digest).unlink(missing_ok=True)
+
+
+__all__ = ['DemStore']
@@ -0,0 +1,95 @@
+"""Concurrent import execution.
+
+Importers spend most of their time waiting for remote services, so running
+them one after another makes a cold search as slow as the sum of all of them.
+`ImportExecutor` runs the fetch and transform phases of every importer on every
+tile group in a bounded worker pool instead, while keeping the number of
+simultaneous requests to each remote source within configured limits."""
+
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+import threading
+
+from stargaze import metrics
+from stargaze.settings import settings
+
+
+class ImportExecutor:
+    """Runs importers on tile groups concurrently.
+
+    Requests to the same source are limited by a semaphore per source, and the
+    total number of concurrent loads is limited so that the connection pool is
+    never exhausted. Every load runs in its own pooled session, and loads of the
+    same importer are serialized, so that concurrent upserts into the same
+    table do not wait for each other's row locks."""
+
+    def __init__(self,
+                 session_factory,
+                 importers,
+                 *,
+                 max_workers: int | None = None,
+                 limits: dict[str, int] | None = None):
+        config = settings['executor']
+        self._session_factory = session_factory
+        self._importers = importers
+        self._max_workers = max_workers or config['max_workers']
+        self._limits = {
+            source: threading.BoundedSemaphore(limit)
+            for source, limit in (limits or config['limits']).items()
+        }
+        self._loads = threading.BoundedSemaphore(config['max_loads'])
+        self._load_locks = [threading.Lock() for _ in importers]
+
+    def _run(self, index: int, group) -> None:
+        """Runs the importer with the given index on the tile group."""
+        importer = self._importers[index]
+        name = type(importer).__qualname__
+        limit = self._limits.get(importer.source) or nullcontext()
+        if importer.stream:
+            # the extract is received while being loaded, so the request and
+            # the load can only be run together
+            with limit, self._load_locks[index], self._loads:
+                print(f'running {name} on {group.bounds}')
+                with self._session_factory.session_scope() as session:
+                    importer.run(group.bounds, session)
+            return
+        with limit:
+            print(f'running {name} on {group.bounds}')
+            with metrics.span('import', importer=name, phase='fetch'):
+                extract = importer.fetch(group.bounds)
+            with metrics.span('import', importer=name, phase='transform'):
+                data = importer.transform(extract)
+        with self._load_locks[index], self._loads:
+            with metrics.span('import', importer=name, phase='load'):
+                with self._session_factory.session_scope() as session:
+                    importer.load(data, session)
+
+    def run(self, groups):
+        """Imports the tile groups and yields each of them once it is done.
+
+        A group is yielded as soon as all importers have loaded its data, so
+        the caller can confirm it while the rest is still being imported. The
+        first failure cancels the pending work and is re-raised."""
+
+        with ThreadPoolExecutor(max_workers=self._max_workers) as pool:
+            futures = {}
+            remaining = []
+            for number, group in enumerate(groups):
+                remaining.append(len(self._importers))
+                for index in range(len(self._importers)):
+                    future = pool.submit(self._run, index, group)
+                    futures[future] = number, group
+            try:
+                for future in as_completed(futures):
+                    future.result()
+                    number, group = futures[future]
+                    remaining[number] -= 1
+                    if remaining[number] == 0:
+                        yield group
+            except BaseException:
+                pool.shutdown(cancel_futures=True)
+                raise
+
+
+__all__ = ['ImportExecutor']
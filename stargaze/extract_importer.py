@@ -0,0 +1,281 @@
+"""Importer of OSM data from local extract files.
+
+Extracts are read in four passes, since OSM XML lists nodes first, then ways
+and relations last, while the geometry of a feature is made of its nodes: the
+first pass collects the selected multipolygon relations, the second one the
+node references of the selected ways and of the member ways of the relations,
+and the third one the coordinates of the nodes of all these ways. The last pass
+produces the selected ways along with their tags, followed by the relations.
+Besides the relations, only identifiers and coordinates are held in memory, in
+flat arrays, so memory use depends on the selected features rather than on the
+size of the extract. The features are produced as the same models the Overpass
+API responses are deserialized into, so they are transformed and loaded by the
+importers they are routed to just like fetched ones, and every batch is
+committed on its own.
+
+Plain, gzip and bzip2 compressed OSM XML sorted by identifiers is supported, as
+produced by osmium. PBF extracts have to be converted first, e.g. by
+`osmium cat extract.osm.pbf -o extract.osm.bz2`."""
+
+
+from array import array
+from bisect import bisect_left
+import bz2
+from datetime import datetime
+import gzip
+import heapq
+import os
+from pathlib import Path as FilePath
+from xml.etree import ElementTree
+
+from stargaze import overpass
+from stargaze.base_importer import BaseImporter
+from stargaze.commons import BoundingBox, Path
+
+
+class _Extract:
+    """Features of an extract exposed like an `overpass.OverpassStream`."""
+
+    def __init__(self, elements, timestamp: datetime | None):
+        self.version = 0.6
+        self.generator = 'stargaze'
+        self.osm3s = {}
+        if timestamp is not None:
+            self.osm3s['timestamp_osm_base'] = timestamp.isoformat()
+        self.elements = elements
+
+
+class ExtractImporter(BaseImporter):
+    """Importer of OSM features from a local extract file.
+
+    Features are selected and routed by the selectors of the given
+    `CombinedImporter`, which also transforms and loads them. The bounds and
+    the time of the extract are known once it has been fetched."""
+
+    def __init__(self,
+                 path: str | os.PathLike,
+                 importer,
+                 batch_size: int = 1000):
+        self._path = FilePath(path)
+        if self._path.name.endswith('.pbf'):
+            raise ValueError(
+                f'PBF extracts are not supported, convert {self._path} to '
+                'OSM XML first'
+            )
+        self._importer = importer
+        self._batch_size = batch_size
+        self.bounds = None
+        self.timestamp = None
+
+    def _open(self):
+        if self._path.suffix == '.bz2':
+            return bz2.open(self._path, 'rb')
+        if self._path.suffix == '.gz':
+            return gzip.open(self._path, 'rb')
+        return open(self._path, 'rb')
+
+    def _parse(self, tag: str):
+        """Yields the elements with the tag, freeing every element after use."""
+        with self._open() as extract:
+            context = ElementTree.iterparse(extract, events=('start', 'end'))
+            _, root = next(context)
+            timestamp = root.get('timestamp')
+            if timestamp:
+                self.timestamp = datetime.fromisoformat(
+                    timestamp.replace('Z', '+00:00')
+                )
+            for event, element in context:
+                if event != 'end':
+                    continue
+                if element.tag == 'bounds':
+                    self.bounds = BoundingBox(
+                        minlat=float(element.get('minlat')),
+                        minlon=float(element.get('minlon')),
+                        maxlat=float(element.get('maxlat')),
+                        maxlon=float(element.get('maxlon'))
+                    )
+                elif element.tag == tag:
+                    yield element
+                elif element.tag not in ('node', 'way', 'relation'):
+                    continue
+                root.clear()
+
+    @staticmethod
+    def _tags(element) -> dict[str, str]:
+        return {tag.get('k'): tag.get('v') for tag in element.iter('tag')}
+
+    def _selected(self, type: str, id: int, tags: dict[str, str]) -> bool:
+        feature = overpass.Feature.model_construct(type=type, id=id, tags=tags)
+        return any(
+            selector.matches(feature) for selector in self._importer.selectors
+        )
+
+    def fetch(self, bounds: BoundingBox | None = None):
+        relations = []
+        members = set()
+        for element in self._parse('relation'):
+            tags = self._tags(element)
+            id = int(element.get('id'))
+            if tags.get('type') != 'multipolygon':
+                continue
+            if not self._selected('relation', id, tags):
+                continue
+            roles = [
+                (int(member.get('ref')), member.get('role'))
+                for member in element.iter('member')
+                if member.get('type') == 'way'
+                and member.get('role') in ('inner', 'outer')
+            ]
+            relations.append((id, tags, roles))
+            members.update(ref for ref, _ in roles)
+
+        # the ways and their node references are kept in flat arrays, the
+        # references of a way being refs[starts[i]:starts[i + 1]], while the
+        # tags of the selected ways are read again when they are produced
+        way_ids = array('q')
+        starts = array('q')
+        selected = bytearray()
+        refs = array('q')
+        for element in self._parse('way'):
+            id = int(element.get('id'))
+            chosen = self._selected('way', id, self._tags(element))
+            if not chosen and id not in members:
+                continue
+            if way_ids and id <= way_ids[-1]:
+                raise ValueError(
+                    f'ways of {self._path} are not sorted by id, sort it '
+                    'first, e.g. by osmium sort'
+                )
+            way_ids.append(id)
+            starts.append(len(refs))
+            selected.append(chosen)
+            refs.extend(int(node.get('ref')) for node in element.iter('nd'))
+        starts.append(len(refs))
+
+        nodes = _sorted_unique(refs)
+        coordinates = array('d', bytes(16 * len(nodes)))
+        found = bytearray(len(nodes))
+        for element in self._parse('node'):
+            id = int(element.get('id'))
+            index = bisect_left(nodes, id)
+            if index < len(nodes) and nodes[index] == id:
+                coordinates[2 * index] = float(element.get('lon'))
+                coordinates[2 * index + 1] = float(element.get('lat'))
+                found[index] = 1
+
+        def way(id: int) -> int | None:
+            """Returns the index of the way, or None if it is not kept."""
+            index = bisect_left(way_ids, id)
+            if index < len(way_ids) and way_ids[index] == id:
+                return index
+            return None
+
+        def geometry(index: int) -> tuple[list[int], Path]:
+            """Returns nodes of the way present in the extract and its path."""
+            way_nodes = []
+            buffer = array('d')
+            for node in refs[starts[index]:starts[index + 1]]:
+                position = bisect_left(nodes, node)
+                if found[position]:
+                    way_nodes.append(node)
+                    buffer.extend(coordinates[2 * position:2 * position + 2])
+            return way_nodes, Path(buffer)
+
+        def elements():
+            for element in self._parse('way'):
+                id = int(element.get('id'))
+                index = way(id)
+                if index is None or not selected[index]:
+                    continue
+                way_nodes, path = geometry(index)
+                if len(way_nodes) < 2 or not _intersects(path, bounds):
+                    continue
+                yield overpass.Way.model_construct(
+                    type='way', id=id, tags=self._tags(element),
+                    bounds=_bounds(path), nodes=way_nodes, geometry=path
+                )
+            for id, tags, roles in relations:
+                # member ways may have no nodes in a clipped extract
+                relation_members = [
+                    overpass.Member.model_construct(
+                        type='way',
+                        ref=ref,
+                        role=overpass.MultipolygonRole(role),
+                        geometry=path
+                    )
+                    for ref, role in roles if way(ref) is not None
+                    for path in (geometry(way(ref))[1],) if len(path) > 0
+                ]
+                if not any(
+                    _intersects(member.geometry, bounds)
+                    for member in relation_members
+                ):
+                    continue
+                boxes = [
+                    _bounds(member.geometry) for member in relation_members
+                ]
+                yield overpass.Multipolygon.model_construct(
+                    type='relation', id=id, tags=tags,
+                    bounds=BoundingBox(
+                        minlat=min(box.minlat for box in boxes),
+                        minlon=min(box.minlon for box in boxes),
+                        maxlat=max(box.maxlat for box in boxes),
+                        maxlon=max(box.maxlon for box in boxes)
+                    ),
+                    members=relation_members
+                )
+
+        return _Extract(elements(), self.timestamp)
+
+    def batches(self, extract):
+        return overpass.batches(extract, self._batch_size)
+
+    def transform(self, extract):
+        return self._importer.transform(extract)
+
+    def load(self, data, session):
+        # every batch is committed, so that a failure does not roll back what
+        # has been loaded already and transactions stay small, which is safe
+        # since features are upserted
+        self._importer.load(data, session)
+        session.commit()
+
+
+def _sorted_unique(values: array, run: int = 1 << 20) -> array:
+    """Returns the distinct values of the array in ascending order.
+
+    The values are sorted in runs of at most `run` values, which are merged
+    afterwards, so that no more than one run is held as Python objects."""
+    runs = []
+    for start in range(0, len(values), run):
+        chunk = values[start:start + run]
+        runs.append(array(values.typecode, sorted(set(chunk))))
+    merged = array(values.typecode)
+    for value in heapq.merge(*runs):
+        if not merged or merged[-1] != value:
+            merged.append(value)
+    return merged
+
+
+def _bounds(path: Path) -> BoundingBox:
+    values = path.values()
+    return BoundingBox(
+        minlat=min(values[1::2]), minlon=min(values[0::2]),
+        maxlat=max(values[1::2]), maxlon=max(values[0::2])
+    )
+
+
+def _intersects(path: Path, bounds: BoundingBox | None) -> bool:
+    """Returns whether the bounding box of the path intersects the bounds."""
+    if bounds is None:
+        return True
+    if len(path) == 0:
+        return False
+    box = _bounds(path)
+    return (
+        box.minlat <= bounds.maxlat and bounds.minlat <= box.maxlat
+        and box.minlon <= bounds.maxlon and bounds.minlon <= box.maxlon
+    )
+
+
+__all__ = ['ExtractImporter']
@@ -6,15 +6,32 @@ string."""
 
 
 from argparse import ArgumentParser
+from pathlib import Path
 import re
 
+import platformdirs
 import requests
 
+from stargaze import metrics
 from stargaze.commons import Coordinates
+from stargaze.geocoding_cache import PlaceCache, TokenBucket, normalize
+from stargaze.settings import settings
 
 
 _format_handler_registry = {}
 
+_config = settings['geocoding']
+_directory = Path(
+    _config['directory'] or platformdirs.user_cache_dir('stargaze')
+)
+_directory.mkdir(parents=True, exist_ok=True)
+_cache = PlaceCache(
+    _directory / 'geocoding.sqlite', _config['ttl'], _config['memory_size']
+)
+_limiter = TokenBucket(
+    _directory / 'geocoding.sqlite', _config['rate'], _config['burst']
+)
+
 
 def find_coordinates(whereabouts: str) -> Coordinates:
     """Finds coordinates corresponding to given whereabouts.
@@ -34,7 +51,8 @@ def find_coordinates(whereabouts: str) -> Coordinates:
     for pattern, format_handler in _format_handler_registry.items():
         match = pattern.fullmatch(whereabouts)
         if match is not None:
-            return format_handler(match)
+            with metrics.span('geocoding', format=format_handler.__name__):
+                return format_handler(match)
     raise ValueError(f'unsupported geocoding format for {whereabouts}')
 
 
@@ -62,6 +80,14 @@ def decimal_degrees(match: re.Match) -> Coordinates:
 
 @geocoding_format(r'.*')
 def nominatim(match: re.Match) -> Coordinates:
+    key = normalize(match.string)
+    coordinates = _cache.get(key)
+    if coordinates is not None:
+        metrics.increment('geocoding_cache', result='hit')
+        return coordinates
+    metrics.increment('geocoding_cache', result='miss')
+    with metrics.span('geocoding_rate_limit'):
+        _limiter.acquire()
     headers = {
         'User-Agent': 'stargaze/1.0 (https://github.com/huleha/stargaze)',
         'Referer': 'https://github.com/huleha/stargaze'
@@ -75,7 +101,9 @@ def nominatim(match: re.Match) -> Coordinates:
     )
     response.raise_for_status()
     feature = response.json()[0]
-    return Coordinates(lat=float(feature['lat']), lon=float(feature['lon']))
+    coordinates = Coordinates(lat=float(feature['lat']), lon=float(feature['lon']))
+    _cache.put(key, coordinates)
+    return coordinates
 
 
 __all__ = ['find_coordinates']
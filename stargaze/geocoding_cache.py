@@ -0,0 +1,161 @@
+"""Caching and rate limiting for geocoding.
+
+Geocoding results rarely change, while public geocoding services limit the rate
+of requests, so results are cached in an in-process LRU on top of a persistent
+SQLite store, and requests which miss the cache go through a token bucket. Both
+the store and the bucket live in the same SQLite file, so they are shared by all
+processes of the application, e.g. by all workers of the web app."""
+
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import os
+from pathlib import Path
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+from stargaze.commons import Coordinates
+
+
+_whitespace = re.compile(r'\s+')
+
+
+def normalize(query: str) -> str:
+    """Returns the cache key of a geocoding query."""
+    query = unicodedata.normalize('NFKC', query).casefold()
+    return _whitespace.sub(' ', query).strip()
+
+
+@contextmanager
+def _connect(path: Path, immediate: bool = True):
+    """Context manager for a transaction on the SQLite file.
+
+    Transactions which write are immediate, i.e. take the write lock up front,
+    reads use a deferred transaction, which does not block other readers."""
+    connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+    try:
+        connection.execute('begin immediate' if immediate else 'begin')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('rollback')
+            raise
+        connection.execute('commit')
+    finally:
+        connection.close()
+
+
+class PlaceCache:
+    """Cache of coordinates by normalized query with expiration."""
+
+    def __init__(self, path: str | os.PathLike, ttl: float, size: int):
+        self._path = Path(path)
+        self._ttl = ttl
+        self._size = size
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        # readers do not wait for a writer in write-ahead logging mode, which
+        # can only be switched to outside of a transaction
+        connection = sqlite3.connect(self._path, timeout=60)
+        try:
+            connection.execute('pragma journal_mode=wal')
+        finally:
+            connection.close()
+        with _connect(self._path) as connection:
+            connection.execute(
+                'create table if not exists places ('
+                'key text primary key, lat real, lon real, expires real)'
+            )
+
+    def _remember(self, key: str, entry: tuple) -> None:
+        with self._lock:
+            self._memory[key] = entry
+            self._memory.move_to_end(key)
+            while len(self._memory) > self._size:
+                self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Coordinates | None:
+        """Returns the cached coordinates, or None if missing or expired."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._memory.move_to_end(key)
+                    return entry[0]
+                del self._memory[key]
+        with _connect(self._path, immediate=False) as connection:
+            row = connection.execute(
+                'select lat, lon, expires from places '
+                'where key = ? and expires > ?',
+                (key, now)
+            ).fetchone()
+        if row is None:
+            return None
+        lat, lon, expires = row
+        coordinates = Coordinates(lat=lat, lon=lon)
+        self._remember(key, (coordinates, expires))
+        return coordinates
+
+    def put(self, key: str, coordinates: Coordinates) -> None:
+        """Caches the coordinates for the time to live of the cache."""
+        expires = time.time() + self._ttl
+        with _connect(self._path) as connection:
+            connection.execute(
+                'insert or replace into places (key, lat, lon, expires) '
+                'values (?, ?, ?, ?)',
+                (key, coordinates.lat, coordinates.lon, expires)
+            )
+            connection.execute(
+                'delete from places where expires <= ?', (time.time(),)
+            )
+        self._remember(key, (coordinates, expires))
+
+
+class TokenBucket:
+    """Rate limiter shared by all processes using the same SQLite file.
+
+    The bucket holds up to `capacity` tokens and is refilled at `rate` tokens
+    per second. Every request takes a token, waiting for one if necessary."""
+
+    def __init__(self, path: str | os.PathLike, rate: float, capacity: float):
+        self._path = Path(path)
+        self._rate = rate
+        self._capacity = capacity
+        with _connect(self._path) as connection:
+            connection.execute(
+                'create table if not exists bucket ('
+                'id integer primary key check (id = 1), '
+                'tokens real not null, updated real not null)'
+            )
+            connection.execute(
+                'insert or ignore into bucket values (1, ?, ?)',
+                (capacity, time.time())
+            )
+
+    def acquire(self) -> None:
+        """Takes a token from the bucket, waiting until one is available."""
+        while True:
+            with _connect(self._path) as connection:
+                tokens, updated = connection.execute(
+                    'select tokens, updated from bucket'
+                ).fetchone()
+                now = time.time()
+                tokens = min(
+                    self._capacity, tokens + max(now - updated, 0) * self._rate
+                )
+                acquired = tokens >= 1
+                if acquired:
+                    tokens -= 1
+                connection.execute(
+                    'update bucket set tokens = ?, updated = ?', (tokens, now)
+                )
+            if acquired:
+                return
+            time.sleep((1 - tokens) / self._rate)
+
+
+__all__ = ['PlaceCache', 'TokenBucket', 'normalize']
@@ -0,0 +1,169 @@
+"""Background jobs of the web app.
+
+Searches may need to import missing tiles first, which takes minutes, so the
+web app runs them as jobs on a small pool of threads instead of in the request
+thread: a request submitting a job returns its id right away, and the state of
+the job is then polled or streamed. The number of jobs waiting for a thread is
+bounded, submitting one more raises `QueueFull`, so that a burst of cold
+searches is turned away instead of piling up.
+
+Jobs are kept in the memory of the process, so the app has to be served by a
+single process, with threads, for the requests about a job to reach the process
+running it. Finished jobs are forgotten after a while, see `JobQueue`."""
+
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import uuid
+
+from stargaze.settings import settings
+
+
+class QueueFull(Exception):
+    """Raised when too many jobs are waiting to be run."""
+
+
+class Job:
+    """State of a job, which can be waited for to change.
+
+    The state is one of 'queued', 'running', 'done' and 'failed'. While running,
+    the job reports its progress as a stage and, for stages counting some work,
+    the amount done and the total. Every change bumps the version of the job,
+    see `wait`."""
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.state = 'queued'
+        self.progress = None
+        self.result = None
+        self.error = None
+        self.finished = None
+        self.version = 0
+        self._changed = threading.Condition()
+
+    @property
+    def over(self) -> bool:
+        return self.state in ('done', 'failed')
+
+    def _update(self, **changes) -> None:
+        with self._changed:
+            for name, value in changes.items():
+                setattr(self, name, value)
+            if self.over:
+                self.finished = time.monotonic()
+            self.version += 1
+            self._changed.notify_all()
+
+    def report(self, stage: str, done: int = 0, total: int = 0) -> None:
+        """Records the progress of the job, given as a callback to the job."""
+        self._update(progress={'stage': stage, 'done': done, 'total': total})
+
+    def snapshot(self) -> dict:
+        """Returns the state of the job as a JSON-serializable dictionary."""
+        with self._changed:
+            snapshot = {
+                'id': self.id,
+                'state': self.state,
+                'progress': self.progress,
+                'version': self.version
+            }
+            if self.state == 'done':
+                snapshot['result'] = self.result
+            if self.state == 'failed':
+                snapshot['error'] = self.error
+            return snapshot
+
+    def wait(self, version: int, timeout: float | None = None) -> bool:
+        """Waits until the job is past the version, returns whether it is."""
+        with self._changed:
+            return self._changed.wait_for(
+                lambda: self.version > version, timeout
+            )
+
+
+class JobQueue:
+    """Runs jobs on a pool of `workers` threads.
+
+    At most `size` jobs wait for a thread at a time. Jobs are looked up by id
+    until `ttl` seconds after they are over."""
+
+    def __init__(self, workers: int = 2, size: int = 16, ttl: float = 600):
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='job'
+        )
+        self._size = size
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._queued = 0
+
+    def submit(self, function, *args) -> Job:
+        """Submits a job calling the function with the arguments.
+
+        The function is also given the keyword argument `progress`, the
+        `Job.report` method of the job. Its return value becomes the result of
+        the job, which has to be JSON-serializable."""
+        self._expire()
+        job = Job()
+        with self._lock:
+            if self._queued >= self._size:
+                raise QueueFull(f'{self._queued} jobs are already waiting')
+            self._queued += 1
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, function, args)
+        return job
+
+    def _run(self, job: Job, function, args) -> None:
+        with self._lock:
+            self._queued -= 1
+        job._update(state='running')
+        try:
+            result = function(*args, progress=job.report)
+        except Exception as exc:
+            job._update(state='failed', error=str(exc) or type(exc).__name__)
+        else:
+            job._update(state='done', result=result)
+
+    def get(self, id: str) -> Job | None:
+        """Returns the job with the id, or `None` if there is none."""
+        with self._lock:
+            return self._jobs.get(id)
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        with self._lock:
+            for id, job in list(self._jobs.items()):
+                if job.over and now - job.finished > self._ttl:
+                    del self._jobs[id]
+
+    def stats(self) -> dict:
+        """Returns the numbers of jobs known by their state."""
+        with self._lock:
+            jobs = list(self._jobs.values())
+        states = {'queued': 0, 'running': 0, 'done': 0, 'failed': 0}
+        for job in jobs:
+            states[job.state] += 1
+        return states
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(cancel_futures=True)
+
+
+_instance = None
+_instance_lock = threading.Lock()
+
+
+def get_queue() -> JobQueue:
+    """Returns the job queue of the process, configured by the settings."""
+    global _instance
+    with _instance_lock:
+        if _instance is None:
+            config = settings['jobs']
+            _instance = JobQueue(
+                config['workers'], config['queue'], config['ttl']
+            )
+        return _instance
+
+
+__all__ = ['Job', 'JobQueue', 'QueueFull', 'get_queue']
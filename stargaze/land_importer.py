@@ -1,8 +1,4 @@
-from textwrap import dedent
-
-import psycopg2
-import psycopg2.extras
-
+from stargaze import bulk_load
 from stargaze import overpass
 from stargaze import wkt
 from stargaze.base_importer import BaseImporter
@@ -13,33 +9,21 @@ from stargaze.sessions import SessionFactory
 class LandImporter(BaseImporter):
     """Importer of land classifying features from OverpassAPI."""
 
-    _overpass_query_template = dedent("""\
-        [out:json][bbox:%s];
-        (
-            way[landuse=construction];
-            way[landuse=farmyard];
-            way[landuse=forest];
-            way[landuse=military];
-            way[natural=water];
-            way[natural=wood];
-            rel[landuse=construction][type=multipolygon];
-            rel[landuse=farmyard][type=multipolygon];
-            rel[landuse=forest][type=multipolygon];
-            rel[landuse=military][type=multipolygon];
-            rel[natural=water][type=multipolygon];
-            rel[natural=wood][type=multipolygon];
-        );
-        out geom;""")
-
-    _insert_stmt = dedent("""\
-        insert into land (ref, shape, type)
-        values %s
-        on conflict (ref) do update set
-            shape = excluded.shape,
-            type = excluded.type;""")
-
-    def __init__(self, endpoint: str | None = None):
+    source = 'overpass'
+
+    selectors = (
+        overpass.Selector(
+            'landuse', ('construction', 'farmyard', 'forest', 'military')
+        ),
+        overpass.Selector('natural', ('water', 'wood')),
+    )
+
+    _table = 'land'
+    _columns = ('ref', 'shape', 'type')
+
+    def __init__(self, endpoint: str | None = None, stream: bool = False):
         self._endpoint = endpoint
+        self.stream = stream
 
     @staticmethod
     def _classify(feature: overpass.Feature) -> str:
@@ -48,8 +32,16 @@ class LandImporter(BaseImporter):
         return feature.tags.get('landuse') or feature.tags.get('natural')
 
     def fetch(self, bounds: BoundingBox):
-        overpass_query = self._overpass_query_template % str(bounds)
-        return overpass.fetch(overpass_query, endpoint=self._endpoint)
+        overpass_query = overpass.query(self.selectors, bounds)
+        return overpass.fetch(
+            overpass_query,
+            endpoint=self._endpoint,
+            stream=self.stream,
+            compact=True
+        )
+
+    def batches(self, extract):
+        return overpass.batches(extract)
 
     def transform(self, extract):
         data = []
@@ -62,7 +54,7 @@ class LandImporter(BaseImporter):
             ):
                 data.append({
                     'ref': feature.id,
-                    'shape': str(wkt.Polygon(feature.geometry)),
+                    'shape': wkt.Polygon(feature.geometry),
                     'type': self._classify(feature)
                 })
                 refs.add(feature.id)
@@ -75,7 +67,7 @@ class LandImporter(BaseImporter):
                     ):
                         data.append({
                             'ref': member.ref,
-                            'shape': str(wkt.Polygon(member.geometry)),
+                            'shape': wkt.Polygon(member.geometry),
                             'type': self._classify(feature)
                             #                      ^^^^^^^
                             # yes, feature, not member, members do not have tags
@@ -84,13 +76,17 @@ class LandImporter(BaseImporter):
         return data
 
     def load(self, data, session):
-        with session.cursor() as cursor:
-            psycopg2.extras.execute_values(
-                cur=cursor,
-                sql=self._insert_stmt,
-                argslist=data,
-                template='(%(ref)s, %(shape)s, %(type)s)'
-            )
+        bulk_load.upsert(
+            session, self._table, self._columns, data, geometries=('shape',)
+        )
+
+    def prune(self, bounds: BoundingBox, refs, session):
+        """Deletes features within the bounds which are not among `refs`.
+
+        `refs` are identifiers by element type, as returned by
+        `overpass.fetch_ids`. Rows are keyed by way identifiers, including
+        those of the member ways of relations."""
+        bulk_load.prune(session, self._table, bounds, refs['way'])
 
 
 def main():
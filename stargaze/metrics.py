@@ -0,0 +1,171 @@
+"""Instrumentation of imports and searches.
+
+Timing spans, counters and collected gauges are kept in a process-wide registry,
+which is rendered in the Prometheus text format for the web app and as a table
+for the command line. A span records how many times a block ran and how long it
+took in total and at most, which is enough to tell where the time of a slow
+search went, e.g. into geocoding, one of the importer phases or the search
+query itself. Plans of searches slower than a threshold can be captured as well,
+see `capture_plan`."""
+
+
+from collections import deque
+from contextlib import contextmanager
+import threading
+import time
+
+
+def _key(name: str, labels: dict) -> tuple:
+    return name, tuple(sorted(labels.items()))
+
+
+class Registry:
+    """Thread-safe registry of counters, timings and gauge collectors."""
+
+    def __init__(self, prefix: str = 'stargaze', plans: int = 10):
+        self._prefix = prefix
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timings = {}
+        self._collectors = []
+        self.plans = deque(maxlen=plans)
+
+    def increment(self, name: str, value: float = 1, **labels) -> None:
+        """Adds the value to the counter with the name and labels."""
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        """Records a duration of the timing with the name and labels."""
+        key = _key(name, labels)
+        with self._lock:
+            count, total, maximum = self._timings.get(key, (0, 0.0, 0.0))
+            self._timings[key] = (
+                count + 1, total + seconds, max(maximum, seconds)
+            )
+
+    @contextmanager
+    def span(self, name: str, **labels):
+        """Context manager recording the duration of the block.
+
+        The duration is recorded even if the block raises, with the label
+        `error` set to the name of the exception."""
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException as exc:
+            labels['error'] = type(exc).__name__
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def register(self, collector) -> None:
+        """Registers a callable returning gauges as (name, labels, value)."""
+        with self._lock:
+            self._collectors.append(collector)
+
+    def reset(self) -> None:
+        """Drops all counters, timings and captured plans."""
+        with self._lock:
+            self._counters.clear()
+            self._timings.clear()
+            self.plans.clear()
+
+    def capture_plan(self, query: str, parameters: dict, plan: str) -> None:
+        """Keeps the plan of a slow query among the most recent ones."""
+        self.plans.append({
+            'time': time.time(),
+            'query': query,
+            'parameters': parameters,
+            'plan': plan
+        })
+
+    def _snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            timings = dict(self._timings)
+            collectors = list(self._collectors)
+        gauges = [gauge for collector in collectors for gauge in collector()]
+        return counters, timings, gauges
+
+    @staticmethod
+    def _labels(labels) -> str:
+        if not labels:
+            return ''
+        pairs = ','.join(
+            '{}="{}"'.format(
+                name,
+                str(value).replace('\\', '\\\\').replace('"', '\\"')
+                .replace('\n', '\\n')
+            )
+            for name, value in labels
+        )
+        return '{' + pairs + '}'
+
+    def render(self) -> str:
+        """Returns the metrics in the Prometheus text exposition format.
+
+        Timings are rendered as summaries without quantiles, along with a gauge
+        of the longest duration."""
+        counters, timings, gauges = self._snapshot()
+        lines = []
+        typed = set()
+
+        def declare(name: str, kind: str) -> str:
+            name = f'{self._prefix}_{name}'
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} {kind}')
+            return name
+
+        for (name, labels), value in sorted(counters.items()):
+            metric = declare(f'{name}_total', 'counter')
+            lines.append(f'{metric}{self._labels(labels)} {value:g}')
+        for (name, labels), (count, total, _) in sorted(timings.items()):
+            metric = declare(f'{name}_seconds', 'summary')
+            lines.append(f'{metric}_sum{self._labels(labels)} {total:g}')
+            lines.append(f'{metric}_count{self._labels(labels)} {count}')
+        for (name, labels), (_, _, maximum) in sorted(timings.items()):
+            metric = declare(f'{name}_seconds_max', 'gauge')
+            lines.append(f'{metric}{self._labels(labels)} {maximum:g}')
+        for name, labels, value in sorted(
+            gauges, key=lambda gauge: (gauge[0], sorted(gauge[1].items()))
+        ):
+            metric = declare(name, 'gauge')
+            lines.append(
+                f'{metric}{self._labels(sorted(labels.items()))} {value:g}'
+            )
+        return '\n'.join(lines) + '\n'
+
+    def report(self) -> str:
+        """Returns timings and counters as a human-readable table."""
+        counters, timings, _ = self._snapshot()
+        lines = [
+            f'{"span":56} {"count":>7} {"total s":>10} {"mean s":>10} '
+            f'{"max s":>10}'
+        ]
+        for (name, labels), (count, total, maximum) in sorted(
+            timings.items(), key=lambda item: -item[1][1]
+        ):
+            label = name + self._labels(labels)
+            lines.append(
+                f'{label:56} {count:7} {total:10.3f} {total / count:10.3f} '
+                f'{maximum:10.3f}'
+            )
+        if counters:
+            lines.append('')
+            lines.append(f'{"counter":56} {"value":>7}')
+            for (name, labels), value in sorted(counters.items()):
+                lines.append(f'{name + self._labels(labels):56} {value:7g}')
+        return '\n'.join(lines)
+
+
+registry = Registry()
+
+increment = registry.increment
+observe = registry.observe
+span = registry.span
+
+
+__all__ = ['Registry', 'increment', 'observe', 'registry', 'span']
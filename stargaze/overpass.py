@@ -1,15 +1,33 @@
+from array import array
+import codecs
+from collections.abc import Iterator
+from dataclasses import dataclass
+from datetime import datetime, timezone
 from enum import Enum
+import json
+import re
 from typing import Any, Literal
 
-from pydantic import BaseModel, Field
+from pydantic import (
+    BaseModel, ConfigDict, Field, TypeAdapter, ValidationInfo, field_validator
+)
 import requests
 
-from stargaze.commons import BoundingBox, Coordinates
+from stargaze import metrics
+from stargaze.commons import BoundingBox, Coordinates, Path
 
 
 _endpoint = 'https://overpass-api.de/api/interpreter'
 
 
+def _compact_geometry(value, info: ValidationInfo):
+    """Stores the geometry in the shared vertex buffer, if there is one."""
+    vertices = (info.context or {}).get('vertices')
+    if vertices is None or isinstance(value, Path):
+        return value
+    return Path.extend(vertices, value)
+
+
 class Feature(BaseModel):
     type: str
     id: int
@@ -19,10 +37,16 @@ class Node(Feature, Coordinates):
     type: Literal['node']
 
 class Way(Feature):
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
     type: Literal['way']
     bounds: BoundingBox
     nodes: list[int]
-    geometry: list[Coordinates]
+    geometry: Path | list[Coordinates]
+
+    _compact_geometry = field_validator('geometry', mode='before')(
+        _compact_geometry
+    )
 
     def is_closed(self) -> bool:
         """Returns whether this way is closed."""
@@ -33,13 +57,21 @@ class MultipolygonRole(str, Enum):
     OUTER = 'outer'
 
 class Member(BaseModel):
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
     type: Literal['way']
     ref: int
     role: MultipolygonRole
-    geometry: list[Coordinates]
+    geometry: Path | list[Coordinates]
+
+    _compact_geometry = field_validator('geometry', mode='before')(
+        _compact_geometry
+    )
 
     def is_closed(self) -> bool:
         """Returns whether this way is closed."""
+        if isinstance(self.geometry, Path):
+            return self.geometry.is_closed()
         return self.geometry[0] == self.geometry[-1]
 
 class Multipolygon(Feature):
@@ -54,7 +86,177 @@ class OverpassResponse(BaseModel):
     elements: list[Node | Way | Multipolygon]
 
 
-def fetch(query: str, endpoint: str | None = None) -> OverpassResponse:
+_element = TypeAdapter(Node | Way | Multipolygon)
+_elements_start = re.compile(r'"elements"\s*:\s*\[')
+_separator = re.compile(r'[\s,]*')
+
+
+class OverpassStream:
+    """Overpass response which is deserialized while it is being received.
+
+    The leading part of the response, that is everything but the elements, is
+    read on construction and exposed as the same attributes `OverpassResponse`
+    has. The `elements` attribute is an iterator, which reads the body further
+    only as far as it is necessary to deserialize the next element, so only a
+    single element is held in memory at a time. A remark the server may append
+    after the elements, e.g. about a timeout, is available as `remark` once the
+    elements have been exhausted. When `compact` is true, the geometry of every
+    element is stored as a `Path` over a buffer of its own."""
+
+    def __init__(self, chunks: Iterator[str], compact: bool = False):
+        self._chunks = chunks
+        self._compact = compact
+        self._buffer = ''
+        self._position = 0
+        header = self._header()
+        self.version = header.get('version')
+        self.generator = header.get('generator')
+        self.osm3s = header.get('osm3s', {})
+        self.remark = None
+        self.elements = self._elements()
+
+    def _read(self, size: int = 1) -> bool:
+        """Appends at least `size` characters to the buffer unless exhausted.
+
+        Returns whether anything has been read at all."""
+        self._buffer = self._buffer[self._position:]
+        self._position = 0
+        target = len(self._buffer) + size
+        read = False
+        while len(self._buffer) < target:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+            read = True
+        return read
+
+    def _header(self) -> dict:
+        while (match := _elements_start.search(self._buffer)) is None:
+            if not self._read():
+                raise ValueError('elements not found in the Overpass response')
+        # the object so far, with the trailing comma replaced by the brace
+        header = self._buffer[:match.start()].rstrip().removesuffix(',') + '}'
+        self._position = match.end()
+        return json.loads(header)
+
+    def _elements(self):
+        decoder = json.JSONDecoder()
+        while True:
+            self._position = _separator.match(self._buffer, self._position).end()
+            if self._position == len(self._buffer):
+                if not self._read():
+                    raise ValueError('truncated Overpass response')
+                continue
+            if self._buffer[self._position] == ']':
+                self._position += 1
+                self._trailer()
+                return
+            try:
+                element, end = decoder.raw_decode(self._buffer, self._position)
+            except json.JSONDecodeError:
+                # the element is incomplete, double the buffer to limit retries
+                if not self._read(len(self._buffer) - self._position):
+                    raise
+                continue
+            self._position = end
+            context = {'vertices': array('d')} if self._compact else None
+            yield _element.validate_python(element, context=context)
+
+    def _trailer(self) -> None:
+        while self._read(1 << 16):
+            pass
+        trailer = self._buffer[self._position:].lstrip().removeprefix(',')
+        self.remark = json.loads('{' + trailer).get('remark')
+
+
+def _decode(response: requests.Response, chunk_size: int = 1 << 16):
+    """Yields the body of the response as text chunks and closes it."""
+    decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')()
+    try:
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            metrics.increment('bytes_received', len(chunk), source='overpass')
+            yield decoder.decode(chunk)
+        yield decoder.decode(b'', final=True)
+    finally:
+        response.close()
+
+
+@dataclass(frozen=True)
+class Selector:
+    """Selector of features by a tag.
+
+    Selects ways, and unless `relations` is false also multipolygon relations,
+    which have the tag `key` set to one of `values`. The same selector is used
+    both to build the query and to tell which elements of a response it is
+    responsible for."""
+
+    key: str
+    values: tuple[str, ...]
+    relations: bool = True
+
+    def statements(self, newer: datetime | None = None) -> list[str]:
+        """Returns OverpassQL statements querying the selected features.
+
+        When `newer` is given, only features changed since then are queried."""
+        since = f'(newer:"{_format(newer)}")' if newer is not None else ''
+        statements = [
+            f'way[{self.key}={value}]{since};' for value in self.values
+        ]
+        if self.relations:
+            statements.extend(
+                f'rel[{self.key}={value}][type=multipolygon]{since};'
+                for value in self.values
+            )
+        return statements
+
+    def matches(self, feature: Feature) -> bool:
+        """Returns whether the feature is selected by this selector."""
+        if feature.type == 'relation' and not self.relations:
+            return False
+        return feature.type != 'node' and feature.tags.get(self.key) in self.values
+
+
+def _format(timestamp: datetime) -> str:
+    return timestamp.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def timestamp(extract: OverpassResponse | OverpassStream) -> datetime | None:
+    """Returns the time of the OSM data the response was generated from."""
+    value = extract.osm3s.get('timestamp_osm_base')
+    if not value:
+        return None
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def query(selectors: list[Selector],
+          bounds: BoundingBox,
+          newer: datetime | None = None,
+          ids: bool = False) -> str:
+    """Builds a query for the union of the selectors within the bounds.
+
+    When `newer` is given, only features changed since then are queried. When
+    `ids` is true, only identifiers of the features are returned, including the
+    ways the multipolygon relations consist of, see `fetch_ids`."""
+    statements = [
+        statement
+        for selector in selectors
+        for statement in selector.statements(newer)
+    ]
+    output = ['out ids;', 'way(r);', 'out ids;'] if ids else ['out geom;']
+    return '\n'.join([
+        f'[out:json][bbox:{bounds}];',
+        '(',
+        *(f'    {statement}' for statement in statements),
+        ');',
+        *output
+    ])
+
+
+def fetch(query: str,
+          endpoint: str | None = None,
+          stream: bool = False,
+          compact: bool = False) -> OverpassResponse | OverpassStream:
     """Sends query to endpoint and returns deserialized response.
 
     This function sends the given OverpassQL query to the given endpoint (Main
@@ -62,14 +264,73 @@ def fetch(query: str, endpoint: str | None = None) -> OverpassResponse:
     as an `OverpassResponse` instance. For simplicity, all geometry-related
     fields are required and multipolygon relations are the only supported type
     of relations, so make sure to always use `out geom` in queries and
-    additionally specify `[type=multipolygon]` when querying relations."""
+    additionally specify `[type=multipolygon]` when querying relations.
 
+    When `stream` is true, the response body is not read at once, but an
+    `OverpassStream` is returned instead, which deserializes the elements one by
+    one as they arrive. When `compact` is true, geometries are deserialized into
+    `Path` objects sharing a single flat vertex buffer instead of lists of
+    `Coordinates`."""
+
+    response = requests.get(endpoint or _endpoint, data=query, stream=stream)
+    response.raise_for_status()
+    if stream:
+        return OverpassStream(_decode(response), compact=compact)
+    metrics.increment(
+        'bytes_received', len(response.content), source='overpass'
+    )
+    context = {'vertices': array('d')} if compact else None
+    return OverpassResponse.model_validate_json(response.text, context=context)
+
+
+def fetch_ids(query: str,
+              endpoint: str | None = None) -> dict[str, set[int]]:
+    """Sends an `ids` query to endpoint and returns the identifiers.
+
+    Ways and relations are numbered separately, so the identifiers are returned
+    by element type."""
     response = requests.get(endpoint or _endpoint, data=query)
     response.raise_for_status()
-    return OverpassResponse.model_validate_json(response.text)
+    metrics.increment(
+        'bytes_received', len(response.content), source='overpass'
+    )
+    ids = {'way': set(), 'relation': set()}
+    for element in response.json()['elements']:
+        ids.setdefault(element['type'], set()).add(element['id'])
+    return ids
+
+
+def batches(extract: OverpassResponse | OverpassStream, size: int = 1000):
+    """Splits a response into responses of at most `size` elements each.
+
+    A response which has been read at once is already in memory, so it is
+    yielded as is. A stream is consumed lazily, one batch at a time, so that
+    each batch can be transformed and loaded before the next one is received."""
+
+    if isinstance(extract, OverpassResponse):
+        yield extract
+        return
+    batch = []
+    for element in extract.elements:
+        batch.append(element)
+        if len(batch) == size:
+            yield _batch(extract, batch)
+            batch = []
+    if batch:
+        yield _batch(extract, batch)
+
+
+def _batch(extract: OverpassStream, elements: list) -> OverpassResponse:
+    return OverpassResponse.model_construct(
+        version=extract.version,
+        generator=extract.generator,
+        osm3s=extract.osm3s,
+        elements=elements
+    )
 
 
 __all__ = [
     'Feature', 'Member', 'Multipolygon', 'MultipolygonRole', 'Node',
-    'OverpassResponse', 'Way', 'fetch'
+    'OverpassResponse', 'OverpassStream', 'Selector', 'Way', 'batches', 'fetch',
+    'fetch_ids', 'query', 'timestamp'
 ]
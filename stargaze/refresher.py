@@ -0,0 +1,98 @@
+"""Incremental refresh of imported tiles.
+
+Tiles are stamped with the time they were imported and the time of the OSM data
+they were imported from. Instead of downloading tiles older than the configured
+age again, the refresher asks the Overpass API only for features changed since
+the data time of the tiles, upserts them, and deletes the features which no
+longer exist or have been re-tagged, which it tells by the identifiers of the
+features each importer still selects within the tiles. Derived data of the
+refreshed tiles is rebuilt when they are confirmed again.
+
+Changes the Overpass API does not attribute to the selected elements themselves,
+e.g. moved nodes of a way or changed ways of a multipolygon, are not picked up,
+those need the tiles to be deleted and imported again."""
+
+
+from datetime import datetime
+
+from stargaze import coverage
+from stargaze.settings import settings
+
+
+_config = settings['refresh']
+
+_stale_tiles_query = """
+    select
+        geohash,
+        ST_YMin(bbox) as south,
+        ST_XMin(bbox) as west,
+        ST_YMax(bbox) as north,
+        ST_XMax(bbox) as east,
+        coalesce(
+            source_timestamp,
+            imported - make_interval(secs => %(margin)s)) as since
+    from tiles
+    where imported < now() - make_interval(secs => %(age)s)
+    order by imported
+    limit %(limit)s"""
+
+
+class Refresher:
+    """Refreshes OSM features of tiles imported long ago.
+
+    `importer` is a `CombinedImporter`, whose features are refreshed, and
+    `confirm` is called with the refreshed tiles and the time of the OSM data
+    they were refreshed to."""
+
+    def __init__(self, session_factory, importer, confirm):
+        self._session_factory = session_factory
+        self._importer = importer
+        self._confirm = confirm
+
+    def stale(self, age: float, limit: int) -> list[tuple]:
+        """Returns tiles imported more than `age` seconds ago, oldest first.
+
+        Every tile is returned with the time since which its changes have to
+        be fetched."""
+        with self._session_factory.session_scope() as session:
+            with session.cursor() as cursor:
+                cursor.execute(
+                    _stale_tiles_query,
+                    {'age': age, 'limit': limit, 'margin': _config['margin']}
+                )
+                return cursor.fetchall()
+
+    def refresh(self, group: coverage.TileGroup, since: datetime) -> None:
+        """Applies changes since the given time to the tiles of the group."""
+        # identifiers are fetched first, so that features created in between
+        # are loaded after pruning and kept
+        refs = self._importer.ids(group.bounds)
+        changes = self._importer.fetch(group.bounds, newer=since)
+        with self._session_factory.session_scope() as session:
+            self._importer.prune(group.bounds, refs, session)
+            for batch in self._importer.batches(changes):
+                self._importer.load(self._importer.transform(batch), session)
+        self._confirm(
+            group.tiles, self._importer.source_timestamp(group.bounds)
+        )
+
+    def run(self, age: float | None = None, limit: int | None = None) -> int:
+        """Refreshes stale tiles and returns the number of refreshed tiles.
+
+        At most `limit` tiles imported more than `age` seconds ago are
+        refreshed, both defaulting to the configured values."""
+        age = _config['age'] if age is None else age
+        limit = _config['limit'] if limit is None else limit
+        stale = self.stale(age, limit)
+        since = {tile[0]: tile[5] for tile in stale}
+        refreshed = 0
+        for group in coverage.plan([tile[:5] for tile in stale]):
+            self.refresh(
+                group, min(since[geohash] for geohash, *_ in group.tiles)
+            )
+            refreshed += len(group.tiles)
+            print(f'refreshed {refreshed}/{len(stale)} tiles')
+        return refreshed
+
+
+__all__ = ['Refresher']
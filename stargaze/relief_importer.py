@@ -1,5 +1,6 @@
-import importlib
+import importlib.resources
 import os
+from pathlib import Path
 import subprocess
 import tempfile
 import tomllib
@@ -8,8 +9,12 @@ from dotenv import load_dotenv
 import psycopg2
 import requests
 
+from stargaze import coverage
+from stargaze import metrics
 from stargaze.base_importer import BaseImporter
 from stargaze.commons import BoundingBox
+from stargaze.dem_store import DemStore
+from stargaze.settings import settings
 
 
 _resources = importlib.resources.files('stargaze.resources')
@@ -37,50 +42,122 @@ def to_params(box: BoundingBox) -> dict:
 class ReliefImporter(BaseImporter):
     """Importing relief data from OpenTopography"""
 
+    source = 'opentopography'
+
     _endpoint = 'https://portal.opentopography.org/API/globaldem'
 
     _table  = 'stargaze.relief'
     _column = 'rast'
 
+    _chunk_size = 1 << 20
+
+    def __init__(self,
+                 store: DemStore | None = None,
+                 offline: bool = False,
+                 endpoint: str | None = None):
+        if offline and store is None:
+            raise ValueError('offline mode requires a DEM store')
+        self._store = store
+        self._offline = offline
+        if endpoint is not None:
+            self._endpoint = endpoint
+
     def fetch(self, bounds):
         """
-        Sends request to the endpoint and returns the response as bytestream.
+        Returns the paths of raster files covering the bounds.
+
+        When a DEM store is given and it covers all the tiles within the bounds,
+        the stored rasters are returned. Otherwise, unless in offline mode, a
+        raster is downloaded and put into the store if any.
+        """
+        if self._store is None:
+            return [self._download(bounds)]
+        geohashes = [tile[0] for tile in coverage.tiles(bounds)]
+        stored = self._store.lookup(geohashes)
+        if stored is not None:
+            return stored
+        if self._offline:
+            raise LookupError(f'relief for {bounds} is not in the DEM store')
+        return [self._store.add(self._download(bounds), geohashes)]
+
+    def _download(self, bounds):
+        """
+        Sends request to the endpoint and returns the path of the raster file.
 
         This function sends a request parametrized with the BoundingBox
         coordinates and name of the global dataset defined as SRTMGL1, with
         30-meter precision, to the OpenTopography endpoint for accessing global
         datasets. The response body contains the raster file, in GeoTiff format
-        by default.
+        by default, which is streamed into a temporary file chunk by chunk.
         """
         params = to_params(bounds)
         params.update(_base_params)
-        response = requests.get(self._endpoint, params=params, stream=True)
-        response.raise_for_status()
-        return response.content
-
-    def transform(self, raster_binary):
+        with requests.get(self._endpoint, params=params, stream=True) as response:
+            response.raise_for_status()
+            with tempfile.NamedTemporaryFile(suffix='.tif', delete=False) as tmp:
+                try:
+                    for chunk in response.iter_content(self._chunk_size):
+                        metrics.increment(
+                            'bytes_received', len(chunk), source=self.source
+                        )
+                        tmp.write(chunk)
+                except BaseException:
+                    os.remove(tmp.name)
+                    raise
+        return Path(tmp.name)
+
+    def transform(self, raster_paths):
         """
-        Transforms the binary image into sql statements
+        Transforms the raster files into sql statements
 
-        This function takes the GTiff image binary, puts into a temporary file
-        and creates an SQL file with insertion statement, returning it in the
-        standard output of the completed process.
+        This function runs raster2pgsql on the GTiff files, cutting the rasters
+        into tiles of bounded size, and writes the resulting insertion
+        statements, one per tile, into a temporary SQL file, whose path is
+        returned. The raster files are removed afterwards, unless they belong to
+        the DEM store.
         """
-        with tempfile.NamedTemporaryFile(suffix='.tif') as tmp:
-            tmp.write(raster_binary)
-            tmp.flush()
-            raster2pgsql_cmd = ["raster2pgsql", "-f", self._column, "-a", tmp.name,
-                                self._table]
-            sql_result = subprocess.run(raster2pgsql_cmd,
-                                        stdout=subprocess.PIPE,
-                                        stderr=subprocess.DEVNULL,
-                                        text=True)
-        return sql_result
-
-    def load(self, sql_result, session):
-        with session.cursor() as cursor:
-            cursor.execute(sql_result.stdout)
-            cursor.execute(_clip_raster)
+        try:
+            with tempfile.NamedTemporaryFile(
+                mode='w', suffix='.sql', delete=False
+            ) as tmp:
+                raster2pgsql_cmd = ["raster2pgsql", "-f", self._column, "-a",
+                                    "-t", settings['relief']['tile_size'],
+                                    *map(str, raster_paths), self._table]
+                try:
+                    subprocess.run(raster2pgsql_cmd,
+                                   stdout=tmp,
+                                   stderr=subprocess.DEVNULL,
+                                   check=True)
+                except BaseException:
+                    os.remove(tmp.name)
+                    raise
+        finally:
+            if self._store is None:
+                for raster_path in raster_paths:
+                    os.remove(raster_path)
+        return Path(tmp.name)
+
+    @staticmethod
+    def _statements(sql_file):
+        """Yields statements of a raster2pgsql output one by one."""
+        statement = []
+        for line in sql_file:
+            statement.append(line)
+            if line.rstrip().endswith(';'):
+                yield ''.join(statement)
+                statement = []
+
+    def load(self, sql_path, session):
+        try:
+            with open(sql_path) as sql_file, session.cursor() as cursor:
+                for statement in self._statements(sql_file):
+                    # the transaction is managed by the session
+                    if statement.strip().upper() in ('BEGIN;', 'END;'):
+                        continue
+                    cursor.execute(statement)
+                cursor.execute(_clip_raster)
+        finally:
+            os.remove(sql_path)
 
 
 def main():
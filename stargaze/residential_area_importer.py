@@ -1,8 +1,4 @@
-from textwrap import dedent
-
-import psycopg2
-import psycopg2.extras
-
+from stargaze import bulk_load
 from stargaze import overpass
 from stargaze import wkt
 from stargaze.base_importer import BaseImporter
@@ -13,26 +9,30 @@ from stargaze.sessions import SessionFactory
 class ResidentialAreaImporter(BaseImporter):
     """Importer of land classifying features from OverpassAPI."""
 
-    _overpass_query_template = dedent("""\
-        [out:json][bbox:%s];
-        (
-            way[landuse=residential];
-            rel[landuse=residential][type=multipolygon];
-        );
-        out geom;""")
-
-    _insert_stmt = dedent("""\
-        insert into residential_area (ref, shape)
-        values %s
-        on conflict (ref) do update set
-            shape = excluded.shape;""")
-
-    def __init__(self, endpoint: str | None = None):
+    source = 'overpass'
+
+    selectors = (
+        overpass.Selector('landuse', ('residential',)),
+    )
+
+    _table = 'residential_area'
+    _columns = ('ref', 'shape')
+
+    def __init__(self, endpoint: str | None = None, stream: bool = False):
         self._endpoint = endpoint
+        self.stream = stream
 
     def fetch(self, bounds: BoundingBox):
-        overpass_query = self._overpass_query_template % str(bounds)
-        return overpass.fetch(overpass_query, endpoint=self._endpoint)
+        overpass_query = overpass.query(self.selectors, bounds)
+        return overpass.fetch(
+            overpass_query,
+            endpoint=self._endpoint,
+            stream=self.stream,
+            compact=True
+        )
+
+    def batches(self, extract):
+        return overpass.batches(extract)
 
     def transform(self, extract):
         data = []
@@ -45,7 +45,7 @@ class ResidentialAreaImporter(BaseImporter):
             ):
                 data.append({
                     'ref': feature.id,
-                    'shape': str(wkt.Polygon(feature.geometry))
+                    'shape': wkt.Polygon(feature.geometry)
                 })
                 refs.add(feature.id)
             elif feature.type == 'relation':
@@ -57,19 +57,23 @@ class ResidentialAreaImporter(BaseImporter):
                     ):
                         data.append({
                             'ref': member.ref,
-                            'shape': str(wkt.Polygon(member.geometry))
+                            'shape': wkt.Polygon(member.geometry)
                         })
                         refs.add(feature.id)
         return data
 
     def load(self, data, session):
-        with session.cursor() as cursor:
-            psycopg2.extras.execute_values(
-                cur=cursor,
-                sql=self._insert_stmt,
-                argslist=data,
-                template='(%(ref)s, %(shape)s)'
-            )
+        bulk_load.upsert(
+            session, self._table, self._columns, data, geometries=('shape',)
+        )
+
+    def prune(self, bounds: BoundingBox, refs, session):
+        """Deletes features within the bounds which are not among `refs`.
+
+        `refs` are identifiers by element type, as returned by
+        `overpass.fetch_ids`. Rows are keyed by way identifiers, including
+        those of the member ways of relations."""
+        bulk_load.prune(session, self._table, bounds, refs['way'])
 
 
 def main():
@@ -1,6 +1,6 @@
 with params as (
     select
-        ST_Envelope(relief.rast) as envelope
+        ST_Envelope(ST_Collect(ST_Envelope(relief.rast))) as envelope
     from
         relief),
 grid as (
@@ -15,10 +15,14 @@ insert into relief_tiles(geohash, bbox, tile)
 select
     grid.geohash,
     grid.bbox,
-    ST_Clip(relief.rast, grid.tile)
+    ST_Clip(ST_Union(relief.rast), grid.tile)
 from
-    relief,
     grid
+    join relief on ST_Intersects(relief.rast, grid.tile)
+group by
+    grid.geohash,
+    grid.bbox,
+    grid.tile
 on conflict (geohash) do update
 set tile = excluded.tile
 ;
@@ -21,6 +21,16 @@ create table if not exists relief_tiles (
     tile raster not null
 );
 
+-- hillshade of relief tiles for a fixed set of azimuth sectors, sector n
+-- heading n * 360 / number of sectors degrees, see build_hillshade_tiles
+create table if not exists hillshade_tiles (
+    geohash character(5) not null,
+    sector smallint not null,
+    bbox box2d not null,
+    tile raster not null,
+    primary key (geohash, sector)
+);
+
 create table if not exists residential_area (
     ref bigint primary key,
     shape geography(Polygon, 4326),
@@ -40,11 +50,58 @@ create table if not exists tiles (
     bbox box2d not null
 );
 
+-- time of the import of a tile and of the OSM data it was imported from
+alter table tiles add column if not exists imported timestamptz not null default now();
+alter table tiles add column if not exists source_timestamp timestamptz;
+
+-- per tile geometries derived from roads and land, see build_tile_masks
+create table if not exists tile_masks (
+    geohash character(5) primary key,
+    bbox box2d not null,
+    calm_roads_buffer geometry(Geometry, 4326) not null,
+    busy_roads_buffer geometry(Geometry, 4326) not null,
+    ineligible_area geometry(Geometry, 4326) not null
+);
+
+-- tiles being imported, see stargaze.tile_claims
+create table if not exists tile_imports (
+    geohash character(5) primary key,
+    owner text not null,
+    started timestamptz not null default now()
+);
+
+-- light pollution surface, see build_light_tiles
+create table if not exists light_tiles (
+    geohash character(5) primary key,
+    bbox box2d not null,
+    tile raster not null
+);
+
+create table if not exists search_cache (
+    key text primary key,
+    area geometry(Polygon, 4326) not null,
+    spots jsonb not null,
+    created timestamptz not null default now()
+);
+
+-- coverage version of the tiles under the area at the time of the search
+alter table search_cache add column if not exists version text;
+
 create index if not exists land_index on land using gist(shape);
 create index if not exists residential_area_index on residential_area using gist(shape);
 create index if not exists roads_index on roads using gist(shape);
+-- planar indexes, for selecting features by bounding boxes like the Overpass API
+create index if not exists land_geometry_index on land using gist((shape::geometry));
+create index if not exists residential_area_geometry_index on residential_area using gist((shape::geometry));
+create index if not exists roads_geometry_index on roads using gist((shape::geometry));
 create index if not exists tiles_index on tiles(geohash);
 create index if not exists relief_tiles_index on relief_tiles using gist(ST_SetSRID(bbox, 4326));
+create index if not exists hillshade_tiles_index on hillshade_tiles using gist(ST_SetSRID(bbox, 4326));
+create index if not exists tile_masks_index on tile_masks using gist(ST_SetSRID(bbox, 4326));
+create index if not exists tiles_imported_index on tiles(imported);
+create index if not exists light_tiles_index on light_tiles using gist(ST_SetSRID(bbox, 4326));
+create index if not exists search_cache_index on search_cache using gist(area);
+create index if not exists search_cache_created_index on search_cache(created);
 
 create or replace function utm_zone(point geometry)
 returns integer as $$
@@ -70,4 +127,318 @@ immutable
 returns null on null input
 parallel safe;
 
+-- Builds masks of the given tiles and the tiles adjacent to them.
+--
+-- The masks are the buffers of calm and busy roads and the union of ineligible
+-- land, each clipped to the tile, so that a search only has to union the masks
+-- of the tiles it covers. Buffers are computed on geography, that is in meters,
+-- while the masks are stored in WGS84 like the rest of the search geometry.
+-- Roads and land of a tile may reach into the adjacent ones, so those are
+-- rebuilt as well.
+create or replace function build_tile_masks(geohashes text[])
+returns void as $$
+    with tile as (
+        select
+            neighbour.geohash,
+            neighbour.bbox,
+            ST_SetSRID(neighbour.bbox::geometry, 4326) as shape
+        from tiles as neighbour
+        where exists (
+            select
+            from tiles
+            where
+                tiles.geohash = any(geohashes)
+                and ST_Intersects(tiles.bbox::geometry, neighbour.bbox::geometry)))
+    insert into tile_masks (
+        geohash, bbox, calm_roads_buffer, busy_roads_buffer, ineligible_area)
+    select
+        tile.geohash,
+        tile.bbox,
+        (select coalesce(
+            ST_Intersection(
+                ST_Union(ST_Buffer(roads.shape, 200)::geometry),
+                tile.shape),
+            ST_GeomFromText('POINT EMPTY', 4326))
+        from roads
+        where
+            roads.type in ('tertiary', 'unclassified', 'residential', 'track', 'road')
+            and ST_DWithin(roads.shape, tile.shape::geography, 200)
+            and not (coalesce(roads.lit, 'no') in ('yes', '24/7'))),
+        (select coalesce(
+            ST_Intersection(
+                ST_Union(ST_Buffer(roads.shape, 500)::geometry),
+                tile.shape),
+            ST_GeomFromText('POINT EMPTY', 4326))
+        from roads
+        where
+            roads.type in ('motorway', 'trunk', 'primary', 'secondary')
+            and ST_DWithin(roads.shape, tile.shape::geography, 500)),
+        (select coalesce(
+            ST_Intersection(ST_Union(land.shape::geometry), tile.shape),
+            ST_GeomFromText('POINT EMPTY', 4326))
+        from land
+        where ST_Intersects(land.shape, tile.shape::geography))
+    from tile
+    on conflict (geohash) do update set
+        bbox = excluded.bbox,
+        calm_roads_buffer = excluded.calm_roads_buffer,
+        busy_roads_buffer = excluded.busy_roads_buffer,
+        ineligible_area = excluded.ineligible_area;
+$$ language sql;
+
+-- Builds hillshade of the given relief tiles and the tiles adjacent to them.
+--
+-- Hillshade of a tile is computed over the union of the tile and its
+-- neighbours and then cut to the extent of the tile, so that there are no
+-- artifacts at tile edges, which is also why the neighbours are rebuilt.
+create or replace function build_hillshade_tiles(
+    geohashes text[],
+    sectors integer,
+    altitude float)
+returns void as $$
+    with tile as (
+        select
+            relief_tiles.geohash,
+            relief_tiles.bbox,
+            relief_tiles.tile,
+            (select ST_Union(surrounding.tile)
+            from relief_tiles as surrounding
+            where ST_Intersects(
+                surrounding.bbox::geometry,
+                relief_tiles.bbox::geometry)) as surroundings
+        from relief_tiles
+        where exists (
+            select
+            from relief_tiles as imported
+            where
+                imported.geohash = any(geohashes)
+                and ST_Intersects(
+                    imported.bbox::geometry,
+                    relief_tiles.bbox::geometry))),
+    sector as (
+        select generate_series(0, sectors - 1) as sector)
+    insert into hillshade_tiles (geohash, sector, bbox, tile)
+    select
+        tile.geohash,
+        sector.sector,
+        tile.bbox,
+        ST_HillShade(
+            tile.surroundings, 1, tile.tile, '8BUI',
+            sector.sector * 360.0 / sectors, altitude)
+    from tile, sector
+    on conflict (geohash, sector) do update set
+        bbox = excluded.bbox,
+        tile = excluded.tile;
+$$ language sql;
+
+-- Returns the coverage version of the area, which changes whenever a tile
+-- intersecting the area is imported or refreshed.
+create or replace function coverage_version(area geometry)
+returns text as $$
+    select md5(coalesce(
+        string_agg(tiles.geohash || ':' || tiles.imported, ',' order by tiles.geohash),
+        ''))
+    from tiles
+    where ST_Intersects(ST_SetSRID(tiles.bbox::geometry, 4326), area);
+$$ language sql stable;
+
+-- Builds light pollution rasters of the tiles within reach of the given tiles.
+--
+-- Every tile gets a raster of resolution x resolution pixels, the value of a
+-- pixel being the sum of area / distance^2 over residential areas larger than
+-- 5000 square meters within reach (in meters) of the tile, the distance being
+-- measured in degrees between the pixel centre and the centre of the area.
+-- Residential areas of a tile affect all the tiles within reach, so besides the
+-- given tiles, the tiles within reach of the residential areas lying in them are
+-- rebuilt as well. Tiles only within reach of residential areas which have been
+-- deleted are not. The areas within reach are looked up once per tile, the
+-- pixels are then computed from that set.
+create or replace function build_light_tiles(
+    geohashes text[],
+    reach float,
+    resolution integer)
+returns void as $$
+    with tile as (
+        select
+            tiles.geohash,
+            tiles.bbox,
+            ST_SetSRID(tiles.bbox::geometry, 4326)::geography as shape,
+            ST_AddBand(
+                ST_MakeEmptyRaster(
+                    resolution, resolution,
+                    ST_XMin(tiles.bbox), ST_YMax(tiles.bbox),
+                    (ST_XMax(tiles.bbox) - ST_XMin(tiles.bbox)) / resolution,
+                    (ST_YMin(tiles.bbox) - ST_YMax(tiles.bbox)) / resolution,
+                    0, 0, 4326),
+                '32BF'::text, 0) as raster
+        from tiles
+        where
+            tiles.geohash = any(geohashes)
+            or exists (
+                select
+                from
+                    tiles as imported
+                    join residential_area as lights on ST_Intersects(
+                        lights.shape::geometry,
+                        ST_SetSRID(imported.bbox::geometry, 4326))
+                where
+                    imported.geohash = any(geohashes)
+                    and lights.area > 5000.0
+                    and ST_DWithin(
+                        lights.shape,
+                        ST_SetSRID(tiles.bbox::geometry, 4326)::geography,
+                        reach))),
+    lit as (
+        select
+            tile.geohash, tile.bbox, tile.raster, lights.centres, lights.areas
+        from
+            tile
+            cross join lateral (
+                select
+                    array_agg(residential_area.centre::geometry) as centres,
+                    array_agg(residential_area.area) as areas
+                from residential_area
+                where
+                    residential_area.area > 5000.0
+                    and ST_DWithin(residential_area.shape, tile.shape, reach)
+            ) as lights)
+    insert into light_tiles (geohash, bbox, tile)
+    select
+        lit.geohash,
+        lit.bbox,
+        ST_SetValues(lit.raster, 1, array(
+            select row(
+                pixel.geom,
+                coalesce(
+                    (select sum(
+                        light.area
+                        / greatest((pixel.geom <-> light.centre) ^ 2, 1e-12))
+                    from unnest(lit.centres, lit.areas) as light(centre, area)),
+                    0))::geomval
+            from ST_PixelAsCentroids(lit.raster) as pixel))
+    from lit
+    on conflict (geohash) do update set
+        bbox = excluded.bbox,
+        tile = excluded.tile;
+$$ language sql;
+
+-- Returns the best spots for observations within radius (in meters) of the
+-- origin, heading the azimuth.
+--
+-- Spots are centres of patches of land large enough, accessible by calm roads,
+-- away from busy roads, not on ineligible land and lit by the hillshade, that
+-- is with a view of the sky in the given direction, ordered by light
+-- pollution. Hillshade is taken from the precomputed sector if all of its tiles
+-- are present and computed on the fly otherwise. The function is a single
+-- statement, so that it is planned once per prepared statement.
+create or replace function stargaze_search(
+    origin geography,
+    radius float,
+    azimuth float,
+    altitude float,
+    sector integer,
+    spot_limit integer)
+returns table (lon float, lat float) as $$
+    with search as (
+        select ST_Buffer(stargaze_search.origin, stargaze_search.radius)::geometry as area),
+    masks as (
+        select tile_masks.*
+        from tile_masks, search
+        where ST_Intersects(ST_SetSRID(tile_masks.bbox, 4326), search.area)),
+    calm_roads_buffer as (
+        select coalesce(
+            ST_Union(masks.calm_roads_buffer),
+            ST_GeomFromText('POINT EMPTY', 4326)) as calm_roads_buffer
+        from masks),
+    busy_roads_buffer as (
+        select coalesce(
+            ST_Union(masks.busy_roads_buffer),
+            ST_GeomFromText('POINT EMPTY', 4326)) as busy_roads_buffer
+        from masks),
+    ineligible_area as (
+        select coalesce(
+            ST_Union(masks.ineligible_area),
+            ST_GeomFromText('POINT EMPTY', 4326)) as ineligible_area
+        from masks),
+    accessible_area as (
+        select ST_Intersection(
+            ST_Difference(
+                ST_Difference(calm_roads_buffer, ineligible_area),
+                busy_roads_buffer),
+            search.area) as accessible_area
+        from calm_roads_buffer, busy_roads_buffer, ineligible_area, search),
+    precomputed_hillshade as (
+        select
+            count(*) = (
+                select count(*)
+                from relief_tiles
+                where ST_Intersects(ST_SetSRID(relief_tiles.bbox, 4326), search.area)
+            ) as complete,
+            ST_Union(hillshade_tiles.tile) as hillshade
+        from hillshade_tiles, search
+        where
+            hillshade_tiles.sector = stargaze_search.sector
+            and ST_Intersects(
+                ST_SetSRID(hillshade_tiles.bbox, 4326),
+                search.area)
+        group by search.area),
+    hillshade as (
+        -- precomputed tiles if all of them are present, computed on the fly otherwise
+        select hillshade
+        from precomputed_hillshade
+        where complete
+        union all
+        select ST_HillShade(
+            ST_Union(relief_tiles.tile), 1, '8BUI',
+            stargaze_search.azimuth, stargaze_search.altitude) as hillshade
+        from relief_tiles, search
+        where
+            ST_Intersects(
+                ST_SetSRID(relief_tiles.bbox, 4326),
+                search.area)
+            and not exists (select from precomputed_hillshade where complete)
+        having count(*) > 0),
+    suitable_area as (
+        select dump.geom as patch
+        from
+            accessible_area,
+            hillshade,
+            ST_DumpAsPolygons(
+                ST_Reclass(
+                    ST_Clip(hillshade, accessible_area, 0),
+                    1, '0-255:0', '8BUI', 255)) as dump),
+    patches as (
+        select ST_Centroid(patch) as centre
+        from suitable_area
+        where ST_Area(patch::geography) > 300000.0),
+    ranked as (
+        select
+            patches.centre as spot,
+            coalesce(ST_Value(light.tile, patches.centre), 0) as disruption
+        from
+            patches
+            left join lateral (
+                select light_tiles.tile
+                from light_tiles
+                where ST_Intersects(ST_SetSRID(light_tiles.bbox, 4326), patches.centre)
+                limit 1) as light on true
+        order by disruption asc
+        limit stargaze_search.spot_limit)
+    select ST_X(spot) as lon, ST_Y(spot) as lat
+    from ranked;
+$$ language sql stable;
+
+-- derived data of tiles imported before it was introduced
+select build_tile_masks(array(
+    select tiles.geohash::text
+    from tiles left join tile_masks using (geohash)
+    where tile_masks.geohash is null));
+-- the reach and the resolution must match [light_pollution] in settings.toml,
+-- seeding and importing extracts build missing light tiles with the configured
+-- values as well, see core.build_missing_light_tiles
+select build_light_tiles(array(
+    select tiles.geohash::text
+    from tiles left join light_tiles using (geohash)
+    where light_tiles.geohash is null), 20000, 16);
+
 commit;
@@ -0,0 +1,16 @@
+with area as (select
+    ST_GeomFromText(%(area)s, 4326) as shape
+)
+select
+    ST_GeoHash(grid.tile, 5) as geohash,
+    ST_YMin(grid.tile) as south,
+    ST_XMin(grid.tile) as west,
+    ST_YMax(grid.tile) as north,
+    ST_XMax(grid.tile) as east
+from
+    area,
+    ST_SquareGrid(180/(2^12), area.shape) as grid(tile)
+    left join tiles on ST_GeoHash(grid.tile, 5) = tiles.geohash
+where
+    ST_Intersects(grid.tile, area.shape)
+    and tiles.geohash is null;
@@ -1,8 +1,4 @@
-from textwrap import dedent
-
-import psycopg2
-import psycopg2.extras
-
+from stargaze import bulk_load
 from stargaze import overpass
 from stargaze import wkt
 from stargaze.base_importer import BaseImporter
@@ -13,54 +9,60 @@ from stargaze.sessions import SessionFactory
 class RoadImporter(BaseImporter):
     """Importer of roads from OverpassAPI."""
 
-    _overpass_query_template = dedent("""\
-        [out:json][bbox:%s];
-        (
-            way[highway=motorway];
-            way[highway=trunk];
-            way[highway=primary];
-            way[highway=secondary];
-            way[highway=tertiary];
-            way[highway=unclassified];
-            way[highway=residential];
-            way[highway=track];
-            way[highway=road];
-        );
-        out geom;""")
-
-    _insert_stmt = dedent("""\
-        insert into roads (ref, shape, type, lit)
-        values %s
-        on conflict (ref) do update set
-            shape = excluded.shape,
-            type = excluded.type,
-            lit = excluded.lit;""")
-
-    def __init__(self, endpoint: str | None = None):
+    source = 'overpass'
+
+    selectors = (
+        overpass.Selector(
+            'highway',
+            (
+                'motorway', 'trunk', 'primary', 'secondary', 'tertiary',
+                'unclassified', 'residential', 'track', 'road'
+            ),
+            relations=False
+        ),
+    )
+
+    _table = 'roads'
+    _columns = ('ref', 'shape', 'type', 'lit')
+
+    def __init__(self, endpoint: str | None = None, stream: bool = False):
         self._endpoint = endpoint
+        self.stream = stream
 
     def fetch(self, bounds):
-        overpass_query = self._overpass_query_template % str(bounds)
-        return overpass.fetch(overpass_query, endpoint=self._endpoint)
+        overpass_query = overpass.query(self.selectors, bounds)
+        return overpass.fetch(
+            overpass_query,
+            endpoint=self._endpoint,
+            stream=self.stream,
+            compact=True
+        )
+
+    def batches(self, extract):
+        return overpass.batches(extract)
 
     def transform(self, extract):
         return [
             {
                 'ref': road.id,
-                'shape': str(wkt.LineString(road.geometry)),
+                'shape': wkt.LineString(road.geometry),
                 'type': road.tags['highway'],
                 'lit': road.tags.get('lit')
             } for road in extract.elements
         ]
 
     def load(self, data, session):
-        with session.cursor() as cursor:
-            psycopg2.extras.execute_values(
-                cur=cursor,
-                sql=self._insert_stmt,
-                argslist=data,
-                template='(%(ref)s, %(shape)s, %(type)s, %(lit)s)'
-            )
+        bulk_load.upsert(
+            session, self._table, self._columns, data, geometries=('shape',)
+        )
+
+    def prune(self, bounds: BoundingBox, refs, session):
+        """Deletes features within the bounds which are not among `refs`.
+
+        `refs` are identifiers by element type, as returned by
+        `overpass.fetch_ids`. Rows are keyed by way identifiers, including
+        those of the member ways of relations."""
+        bulk_load.prune(session, self._table, bounds, refs['way'])
 
 
 def main():
@@ -0,0 +1,125 @@
+"""Cache of search results.
+
+Searches are expensive, while many of them are repeated, e.g. the same town,
+which is geocoded to the same coordinates, searched with the same radius
+heading the same cardinal direction. Results are stored by the exact search
+parameters in the `search_cache` table, so they are shared by all processes
+using the database. Every entry records the coverage version of the tiles under
+its search area, taken before the search, and is only returned while the
+version is the same, so an entry is never served for tiles imported after the
+search read them. Entries are also dropped when tiles under the search area are
+imported, or when they get too old."""
+
+
+import json
+
+from stargaze import wkt
+from stargaze.commons import Coordinates
+from stargaze.settings import settings
+
+
+_config = settings['search_cache']
+
+
+def key(origin: Coordinates, radius: float, azimuth: float | None) -> str:
+    """Returns the cache key of search parameters."""
+    return f'{origin.lat!r},{origin.lon!r};{radius!r};{azimuth!r}'
+
+
+def version(session, origin: Coordinates, radius: float) -> str:
+    """Returns the coverage version of the search area, see `put`."""
+    with session.cursor() as cursor:
+        cursor.execute(
+            'select coverage_version('
+            'ST_Buffer(ST_GeomFromText(%s, 4326)::geography, %s)::geometry)',
+            (str(wkt.Point(origin)), radius)
+        )
+        return cursor.fetchone()[0]
+
+
+def get(session, cache_key: str) -> list[Coordinates] | None:
+    """Returns cached spots for the key, or None if there are none.
+
+    Entries whose coverage version is no longer current are not returned."""
+    with session.cursor() as cursor:
+        cursor.execute(
+            'select spots from search_cache '
+            'where key = %s and created > now() - make_interval(secs => %s) '
+            'and version = coverage_version(area)',
+            (cache_key, _config['ttl'])
+        )
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    return [Coordinates(lat=lat, lon=lon) for lat, lon in row[0]]
+
+
+def put(session,
+        cache_key: str,
+        origin: Coordinates,
+        radius: float,
+        spots: list[Coordinates],
+        coverage: str) -> None:
+    """Caches spots found in the search area and evicts stale entries.
+
+    `coverage` is the coverage version of the search area returned by
+    `version` before the search was run."""
+    with session.cursor() as cursor:
+        cursor.execute(
+            'insert into search_cache (key, area, spots, version) '
+            'values (%s, '
+            'ST_Buffer(ST_GeomFromText(%s, 4326)::geography, %s)::geometry, '
+            '%s, %s) '
+            'on conflict (key) do update set '
+            'area = excluded.area, spots = excluded.spots, '
+            'version = excluded.version, created = now()',
+            (
+                cache_key,
+                str(wkt.Point(origin)),
+                radius,
+                json.dumps([[spot.lat, spot.lon] for spot in spots]),
+                coverage
+            )
+        )
+        _evict(cursor)
+
+
+def _evict(cursor) -> None:
+    """Drops expired entries, and the oldest ones once there are too many.
+
+    The number of entries is taken from the planner statistics, so that it
+    is not counted on every search, and the oldest entries are dropped down
+    to nine tenths of the maximum, so that they are not dropped one by one.
+    Both deletions use the index on the creation time."""
+    cursor.execute(
+        'delete from search_cache '
+        'where created <= now() - make_interval(secs => %s)',
+        (_config['ttl'],)
+    )
+    cursor.execute(
+        "select reltuples from pg_class where oid = 'search_cache'::regclass"
+    )
+    if cursor.fetchone()[0] <= _config['max_entries']:
+        return
+    cursor.execute(
+        'delete from search_cache where created < ('
+        'select created from search_cache order by created desc '
+        'offset %s limit 1)',
+        (_config['max_entries'] * 9 // 10,)
+    )
+
+
+def invalidate(session, tiles) -> None:
+    """Drops cached results of searches overlapping with the tiles."""
+    with session.cursor() as cursor:
+        cursor.executemany(
+            'delete from search_cache '
+            'where ST_Intersects(area, ST_SetSRID(%s::box2d, 4326))',
+            [
+                (str(wkt.Box(south=south, west=west, north=north, east=east)),)
+                for _, south, west, north, east in tiles
+            ]
+        )
+
+
+__all__ = ['get', 'invalidate', 'key', 'put', 'version']
@@ -1,68 +1,381 @@
 """Database connection pooling."""
 
 
+from collections import deque
 from contextlib import contextmanager
-import importlib
+import importlib.resources
+import itertools
+import threading
+import time
 import tomllib
 
-from psycopg2.pool import SimpleConnectionPool
+import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import PoolError
+
+from stargaze import metrics
+from stargaze.settings import settings
 
 
 _resources = importlib.resources.files('stargaze.resources')
 
 
+class ConnectionPool:
+    """Thread-safe pool of database connections.
+
+    Up to `max_size` connections are opened on demand, and callers wait up to
+    `timeout` seconds for one to be returned when all of them are in use.
+    Connections idle for longer than `check_idle` seconds are checked before
+    being handed out, and broken connections or connections older than
+    `max_age` seconds are replaced with new ones."""
+
+    def __init__(self,
+                 credentials: dict,
+                 name: str = 'primary',
+                 min_size: int = 1,
+                 max_size: int = 10,
+                 timeout: float = 30,
+                 max_age: float = 3600,
+                 check_idle: float = 30):
+        self._credentials = credentials
+        self.name = name
+        self._max_size = max_size
+        self._timeout = timeout
+        self._max_age = max_age
+        self._check_idle = check_idle
+        self._condition = threading.Condition()
+        # idle connections with the time they were returned, most recent last
+        self._idle = deque()
+        self._created = {}
+        # connections being opened outside of the lock
+        self._pending = 0
+        self._in_use = set()
+        self._closed = False
+        self._checkouts = 0
+        self._timeouts = 0
+        self._wait = 0.0
+        self._max_wait = 0.0
+        self._busy = 0.0
+        self._since = time.monotonic()
+        self._changed = self._since
+        for _ in range(min_size):
+            connection = self._connect()
+            self._created[connection] = time.monotonic()
+            self._idle.append((connection, time.monotonic()))
+
+    def _connect(self):
+        return psycopg2.connect(**self._credentials)
+
+    def _size(self) -> int:
+        return len(self._created) + self._pending
+
+    def _discard(self, connection) -> None:
+        self._created.pop(connection, None)
+        if not connection.closed:
+            connection.close()
+
+    def _account(self) -> None:
+        """Integrates the number of connections in use over time."""
+        now = time.monotonic()
+        self._busy += len(self._in_use) * (now - self._changed)
+        self._changed = now
+
+    def _usable(self, connection, returned: float) -> bool:
+        if connection.closed:
+            return False
+        if time.monotonic() - self._created[connection] > self._max_age:
+            return False
+        if time.monotonic() - returned > self._check_idle:
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute('select 1')
+                connection.rollback()
+            except psycopg2.Error:
+                return False
+        return True
+
+    def getconn(self, timeout: float | None = None):
+        """Returns a connection, waiting for one if all of them are in use.
+
+        Raises PoolError if no connection becomes available in time."""
+        timeout = self._timeout if timeout is None else timeout
+        start = time.monotonic()
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise PoolError('connection pool is closed')
+                if self._idle or self._size() < self._max_size:
+                    break
+                remaining = start + timeout - time.monotonic()
+                if remaining <= 0 or not self._condition.wait(remaining):
+                    if not self._idle and self._size() >= self._max_size:
+                        self._timeouts += 1
+                        raise PoolError(
+                            f'no connection available within {timeout} s'
+                        )
+            # reserve a slot, so that checking and connecting happen outside
+            # of the lock
+            entry = self._idle.pop() if self._idle else None
+            if entry is None:
+                self._pending += 1
+            self._account()
+            placeholder = object()
+            self._in_use.add(placeholder)
+        connection = None
+        try:
+            if entry is not None:
+                connection, returned = entry
+                if not self._usable(connection, returned):
+                    with self._condition:
+                        self._discard(connection)
+                        self._pending += 1
+                    connection = None
+            if connection is None:
+                connection = self._connect()
+                with self._condition:
+                    self._pending -= 1
+                    self._created[connection] = time.monotonic()
+        except BaseException:
+            with self._condition:
+                self._account()
+                if connection is None:
+                    self._pending -= 1
+                self._in_use.discard(placeholder)
+                self._condition.notify()
+            raise
+        waited = time.monotonic() - start
+        with self._condition:
+            self._account()
+            self._in_use.discard(placeholder)
+            self._in_use.add(connection)
+            self._checkouts += 1
+            self._wait += waited
+            self._max_wait = max(self._max_wait, waited)
+        metrics.observe('pool_wait', waited, pool=self.name)
+        return connection
+
+    def putconn(self, connection, discard: bool = False) -> None:
+        """Returns the connection to the pool.
+
+        Connections left in a transaction are rolled back, and broken ones,
+        or the ones the caller asks to discard, are closed."""
+        if not discard and not connection.closed:
+            status = connection.info.transaction_status
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                discard = True
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    connection.rollback()
+                except psycopg2.Error:
+                    discard = True
+        with self._condition:
+            self._account()
+            self._in_use.discard(connection)
+            if discard or connection.closed or self._closed:
+                self._discard(connection)
+            else:
+                self._idle.append((connection, time.monotonic()))
+            self._condition.notify()
+
+    def closeall(self) -> None:
+        """Closes idle connections and those in use once they are returned."""
+        with self._condition:
+            self._closed = True
+            while self._idle:
+                connection, _ = self._idle.pop()
+                self._discard(connection)
+            self._condition.notify_all()
+
+    def load(self) -> float:
+        """Returns the fraction of the maximum number of connections in use."""
+        with self._condition:
+            return len(self._in_use) / self._max_size
+
+    def stats(self) -> dict:
+        """Returns usage statistics of the pool.
+
+        Utilization is the average fraction of the maximum number of
+        connections in use since the pool was created."""
+        with self._condition:
+            self._account()
+            elapsed = max(self._changed - self._since, 1e-9)
+            return {
+                'size': len(self._created),
+                'max_size': self._max_size,
+                'in_use': len(self._in_use),
+                'idle': len(self._idle),
+                'checkouts': self._checkouts,
+                'timeouts': self._timeouts,
+                'wait_total': self._wait,
+                'wait_mean': self._wait / self._checkouts if self._checkouts else 0.0,
+                'wait_max': self._max_wait,
+                'utilization': self._busy / (elapsed * self._max_size),
+            }
+
+
 class SessionFactory:
+    """Sessions of the primary database and its read replicas.
+
+    Read replicas are listed as `[[replicas]]` tables in the credentials, each
+    overriding the credentials of the primary, e.g. its host. Read-only sessions
+    go to the least busy replica, taking turns among equally busy ones, except
+    for a short while after the process wrote data, e.g. imported tiles, which
+    might not have reached the replicas yet. The time of the last write is
+    known only to the process which wrote, so other processes may still read
+    from lagging replicas. Sessions fall back to the primary when there are no
+    replicas, or when the replicas have no connection available within a short
+    timeout. A replica which cannot be reached is left alone for a while before
+    it is tried again, and connecting to it is given up on after a few
+    seconds, see the `[replicas]` settings."""
 
     _instance = None
+    _lock = threading.Lock()
 
     def __init__(self, credentials):
-        self.pool = SimpleConnectionPool(
-            minconn=1,
-            maxconn=3,
-            **credentials
-        )
+        credentials = dict(credentials)
+        replicas = credentials.pop('replicas', [])
+        self.pool = self._pool(credentials, 'primary')
+        # replicas connect lazily, so that one being down does not prevent
+        # starting up
+        config = settings['replicas']
+        self.replicas = [
+            self._pool(
+                credentials
+                | {'connect_timeout': config['connect_timeout']}
+                | replica,
+                f'replica-{index}',
+                min_size=0
+            )
+            for index, replica in enumerate(replicas)
+        ]
+        # monotonic time until which a replica which failed is not tried
+        self._backoff = {}
+        metrics.registry.register(self._gauges)
+        self._turn = itertools.count()
+        self._written = None
         self.open = True
 
+    @staticmethod
+    def _pool(credentials,
+              name: str,
+              min_size: int | None = None) -> ConnectionPool:
+        config = settings['pool']
+        return ConnectionPool(
+            credentials,
+            name,
+            min_size=config['min_size'] if min_size is None else min_size,
+            max_size=config['max_size'],
+            timeout=config['timeout'],
+            max_age=config['max_age'],
+            check_idle=config['check_idle']
+        )
+
     @classmethod
     def get_instance(cls):
         """Returns a session factory instance."""
-        if cls._instance is None:
-            with open(_resources/'credentials.toml', 'rb') as credentials_file:
-                credentials = tomllib.load(credentials_file)
-            cls._instance = SessionFactory(credentials)
+        with cls._lock:
+            if cls._instance is None:
+                with open(_resources/'credentials.toml', 'rb') as credentials_file:
+                    credentials = tomllib.load(credentials_file)
+                cls._instance = SessionFactory(credentials)
         return cls._instance
 
     def execute(self, transaction):
         """Executes given transaction logic."""
-        with session_scope(self) as session:
+        with self.session_scope() as session:
             return transaction(session)
 
-    def get_session(self):
+    def get_session(self, timeout: float | None = None):
         """Acquires and returns a session."""
-        return self.pool.getconn()
+        return self.pool.getconn(timeout)
 
-    def put_session(self, session):
+    def put_session(self, session, discard: bool = False):
         """Releases session."""
-        return self.pool.putconn(session)
+        return self.pool.putconn(session, discard)
+
+    def mark_written(self) -> None:
+        """Sends reads to the primary while replicas may lag behind it."""
+        self._written = time.monotonic()
+
+    def _replicas(self) -> list[ConnectionPool]:
+        """Returns replicas to read from, the preferred first."""
+        if not self.replicas:
+            return []
+        written = self._written
+        if (written is not None
+                and time.monotonic() - written < settings['replicas']['sticky']):
+            return []
+        now = time.monotonic()
+        available = [
+            replica for replica in self.replicas
+            if self._backoff.get(replica, 0) <= now
+        ]
+        if not available:
+            return []
+        turn = next(self._turn) % len(available)
+        replicas = available[turn:] + available[:turn]
+        # sorting is stable, so equally busy replicas take turns
+        return sorted(replicas, key=ConnectionPool.load)
+
+    def stats(self) -> dict:
+        """Returns usage statistics of the connection pools."""
+        return {
+            'primary': self.pool.stats(),
+            'replicas': [replica.stats() for replica in self.replicas]
+        }
+
+    def _gauges(self):
+        """Yields usage of the connection pools as metric gauges."""
+        for pool in [self.pool, *self.replicas]:
+            stats = pool.stats()
+            for gauge in ('size', 'in_use', 'idle', 'utilization'):
+                yield f'pool_{gauge}', {'pool': pool.name}, stats[gauge]
+            yield 'pool_timeouts', {'pool': pool.name}, stats['timeouts']
 
     def close(self):
-        """Closes connection pool."""
+        """Closes connection pools."""
         if self.open:
             self.pool.closeall()
+            for replica in self.replicas:
+                replica.closeall()
             self.open = False
 
     @contextmanager
-    def session_scope(self):
-        """Context manager for a session."""
-        session = self.get_session()
+    def session_scope(self, readonly: bool = False):
+        """Context manager for a session.
+
+        Read-only sessions may be served by a read replica."""
+        pool = None
+        if readonly:
+            config = settings['replicas']
+            for replica in self._replicas():
+                try:
+                    session = replica.getconn(timeout=config['timeout'])
+                except PoolError:
+                    continue
+                except psycopg2.OperationalError as exc:
+                    print(f'{replica.name} is unavailable: {exc}')
+                    self._backoff[replica] = (
+                        time.monotonic() + config['backoff']
+                    )
+                    continue
+                pool = replica
+                break
+        if pool is None:
+            pool = self.pool
+            session = pool.getconn()
+        broken = False
         try:
             yield session
             session.commit()
         except Exception as exc:
-            session.rollback()
+            try:
+                session.rollback()
+            except psycopg2.Error:
+                broken = True
             raise exc
         finally:
-            self.put_session(session)
+            pool.putconn(session, discard=broken)
 
     def __enter__(self):
         return self
@@ -71,6 +384,6 @@ class SessionFactory:
         self.close()
 
     def __del__(self):
-        if self.open:
+        if getattr(self, 'open', False):
             print("Session factory was not closed properly, closing now")
             self.close()
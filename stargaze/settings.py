@@ -0,0 +1,17 @@
+"""Application settings.
+
+Tunables are read once from the packaged `settings.toml` resource and exposed as
+the nested dictionary `settings`, one table per subsystem."""
+
+
+import importlib.resources
+import tomllib
+
+
+_resources = importlib.resources.files('stargaze.resources')
+
+with open(_resources / 'settings.toml', 'rb') as settings_file:
+    settings = tomllib.load(settings_file)
+
+
+__all__ = ['settings']
@@ -0,0 +1,97 @@
+"""Coordination of tile imports between workers.
+
+Workers which need the same missing tiles at the same time would otherwise all
+download and load them. Before importing, a worker therefore claims the tiles in
+the `tile_imports` table, and imports only those it has claimed, while it waits
+for the others to be imported by the workers holding their claims. Claims are
+dropped when the tiles are confirmed or the import fails. A worker renews its
+claims periodically while importing, see `heartbeat`, and claims not renewed
+within the configured expiration are taken over, so that a crashed worker
+blocks the tiles only briefly. The table lives in the database, so imports are
+deduplicated across processes and hosts."""
+
+
+from contextlib import contextmanager
+import os
+import socket
+import threading
+import uuid
+
+
+def owner() -> str:
+    """Returns a new identifier of a claim owner."""
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+
+def claim(session, geohashes: list[str], owner: str, expire: float) -> set[str]:
+    """Claims the tiles which are neither present, nor claimed by others.
+
+    Claims not renewed for `expire` seconds are taken over. Returns the
+    geohashes of the claimed tiles."""
+    with session.cursor() as cursor:
+        cursor.execute(
+            'insert into tile_imports (geohash, owner) '
+            'select wanted.geohash, %s '
+            'from unnest(%s::text[]) as wanted(geohash) '
+            'where not exists ('
+            'select from tiles where tiles.geohash = wanted.geohash) '
+            'on conflict (geohash) do update set '
+            'owner = excluded.owner, started = now() '
+            'where tile_imports.started < now() - make_interval(secs => %s) '
+            'returning geohash',
+            (owner, geohashes, expire)
+        )
+        return {geohash.strip() for geohash, in cursor}
+
+
+def release(session, owner: str) -> None:
+    """Drops all claims of the owner."""
+    with session.cursor() as cursor:
+        cursor.execute('delete from tile_imports where owner = %s', (owner,))
+
+
+def renew(session, owner: str) -> None:
+    """Renews all claims of the owner, so that they are not taken over."""
+    with session.cursor() as cursor:
+        cursor.execute(
+            'update tile_imports set started = now() where owner = %s',
+            (owner,)
+        )
+
+
+@contextmanager
+def heartbeat(session_factory, owner: str, interval: float):
+    """Context manager renewing the claims of the owner every `interval`
+    seconds while the block runs."""
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(interval):
+            try:
+                with session_factory.session_scope() as session:
+                    renew(session, owner)
+            except Exception as exc:
+                print(f'failed to renew claims of {owner}: {exc}')
+
+    thread = threading.Thread(target=beat, name='claims', daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def absent(session, geohashes: list[str]) -> set[str]:
+    """Returns the geohashes of the tiles which are not present yet."""
+    with session.cursor() as cursor:
+        cursor.execute(
+            'select wanted.geohash from unnest(%s::text[]) as wanted(geohash) '
+            'where not exists ('
+            'select from tiles where tiles.geohash = wanted.geohash)',
+            (geohashes,)
+        )
+        return {geohash for geohash, in cursor}
+
+
+__all__ = ['absent', 'claim', 'heartbeat', 'owner', 'release', 'renew']
@@ -5,10 +5,19 @@ in Well-Known Text (WKT) format. It is meant to be a simple utility module for
 this project and does not make an effort to respect differences between WKT and
 PostGIS's EWKT, support coordinates with the third dimension Z and measurement
 label M, nor be complete. After constructing an object, the textual
-representation can be obtained by calling `str` with this object."""
+representation can be obtained by calling `str` with this object.
 
+Points, line strings and polygons can also be encoded in PostGIS's Extended
+Well-Known Binary (EWKB) format with `ewkb`, or many at once with `encode`,
+which is considerably faster than building WKT vertex by vertex and is accepted
+by PostGIS wherever WKT is."""
 
-from stargaze.commons import Coordinates
+
+from array import array
+import struct
+import sys
+
+from stargaze.commons import Coordinates, Path
 
 
 class Box:
@@ -27,18 +36,28 @@ class Box:
 
 class Point:
 
+    _wkb_type = 1
+
     def __init__(self, point: Coordinates):
         self.point = point
 
+    def _parts(self):
+        return [[self.point]]
+
     def __str__(self):
         return 'Point({point})'.format(point=_point(self.point))
 
 
 class LineString:
 
+    _wkb_type = 2
+
     def __init__(self, path: list[Coordinates]):
         self.path = path
 
+    def _parts(self):
+        return [self.path]
+
     def __str__(self):
         return 'LineString{points}'.format(points=_point_string(self.path))
 
@@ -54,9 +73,14 @@ class LinearRing:
 
 class Polygon:
 
+    _wkb_type = 3
+
     def __init__(self, shell: list[Coordinates]):
         self._rings = [shell]
 
+    def _parts(self):
+        return self._rings
+
     def hole(self, hole: list[Coordinates]):
         """Adds a hole to this polygon."""
         self._rings.append(hole)
@@ -77,7 +101,78 @@ def _point(point: Coordinates) -> str:
     return '{lon} {lat}'.format(lon=point.lon, lat=point.lat)
 
 def _point_string(path: list[Coordinates]) -> str:
+    if isinstance(path, Path):
+        values = list(map(str, path.values()))
+        points = map(' '.join, zip(values[0::2], values[1::2]))
+        return '(' + ', '.join(points) + ')'
     return '(' + ', '.join(map(_point, path)) + ')'
 
 
-__all__ = ['Box', 'Point', 'LineString', 'LinearRing', 'Polygon']
+_srid_flag = 0x20000000
+_byte_order = 1 if sys.byteorder == 'little' else 0
+
+
+def _values(path: list[Coordinates]) -> array:
+    """Returns the coordinates of the path as a flat array of doubles."""
+    if isinstance(path, Path):
+        return path.values()
+    values = array('d')
+    for point in path:
+        values.append(point.lon)
+        values.append(point.lat)
+    return values
+
+
+def _write_ewkb(buffer: bytearray, geometry, srid: int) -> None:
+    try:
+        wkb_type = geometry._wkb_type
+    except AttributeError:
+        raise TypeError(
+            'cannot encode {type} as EWKB'
+            .format(type=type(geometry).__qualname__)
+        ) from None
+    parts = geometry._parts()
+    # the native byte order is used, so that arrays can be copied as they are
+    buffer += struct.pack('=BII', _byte_order, wkb_type | _srid_flag, srid)
+    if wkb_type == Polygon._wkb_type:
+        buffer += struct.pack('=I', len(parts))
+    for part in parts:
+        values = _values(part)
+        if wkb_type != Point._wkb_type:
+            buffer += struct.pack('=I', len(values) // 2)
+        buffer += values.tobytes()
+
+
+def ewkb(geometry, srid: int = 4326) -> bytes:
+    """Returns the EWKB representation of a point, line string or polygon."""
+    buffer = bytearray()
+    _write_ewkb(buffer, geometry, srid)
+    return bytes(buffer)
+
+
+def encode(geometries, format: str = 'ewkb', srid: int = 4326) -> list[str]:
+    """Encodes many geometries at once.
+
+    Returns hex-encoded EWKB representations of the given points, line strings
+    and polygons when `format` is 'ewkb', or their WKT representations when it
+    is 'wkt'. Hex-encoded EWKB is the canonical textual form of PostGIS
+    geometries, so it can be used anywhere WKT is accepted."""
+
+    if format == 'wkt':
+        return list(map(str, geometries))
+    if format != 'ewkb':
+        raise ValueError(f'unsupported format {format}')
+    buffer = bytearray()
+    offsets = [0]
+    for geometry in geometries:
+        _write_ewkb(buffer, geometry, srid)
+        offsets.append(2 * len(buffer))
+    encoded = buffer.hex()
+    return [
+        encoded[start:stop] for start, stop in zip(offsets[:-1], offsets[1:])
+    ]
+
+
+__all__ = [
+    'Box', 'Point', 'LineString', 'LinearRing', 'Polygon', 'encode', 'ewkb'
+]
@@ -0,0 +1,46 @@
+"""Tests of `stargaze.bulk_load` against the database configured in
+`credentials.toml`, skipped when it is not reachable."""
+
+
+import pytest
+
+from stargaze import bulk_load
+from stargaze.commons import BoundingBox
+
+
+@pytest.fixture
+def session():
+    sessions = pytest.importorskip('stargaze.sessions')
+    try:
+        factory = sessions.SessionFactory.get_instance()
+        session = factory.get_session(timeout=5)
+    except Exception as exc:
+        pytest.skip(f'database is not available: {exc}')
+    try:
+        yield session
+    finally:
+        session.rollback()
+        factory.put_session(session)
+
+
+def test_prune_keeps_features_just_past_a_wide_group(session):
+    # a group of 64 tiles at 50°N, whose northern edge as a great-circle arc
+    # would bulge about 940 m to the north in its middle
+    bounds = BoundingBox(minlat=49.956, minlon=18.0, maxlat=50.0, maxlon=20.8)
+    with session.cursor() as cursor:
+        cursor.execute(
+            'create temporary table features ('
+            'ref bigint primary key, shape geography(Geometry, 4326))'
+        )
+        cursor.execute(
+            "insert into features values "
+            "(1, 'SRID=4326;POINT(19.4 50.004)'), "
+            "(2, 'SRID=4326;POINT(19.4 49.98)'), "
+            "(3, 'SRID=4326;POINT(19.4 49.97)')"
+        )
+    deleted = bulk_load.prune(session, 'features', bounds, {3})
+    with session.cursor() as cursor:
+        cursor.execute('select ref from features order by ref')
+        remaining = [ref for ref, in cursor]
+    assert deleted == 1
+    assert remaining == [1, 3]